@@ -0,0 +1,97 @@
+"""
+Benchmark the display identity lookup of `report_display` before and after the identity indexes.
+
+Usage: python benchmarks/display_lookup.py [--displays 100000] [--lookups 1000]
+
+Populates a throwaway SQLite database migrated up to 0004, prints the query plan and timing of the lookup done by
+`varsdaa.ingest.resolve_displays`, then migrates to 0005 and does the same again.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def setup(database_name):
+    from varsdaa.test import settings as test_settings
+
+    configuration = {name: getattr(test_settings, name) for name in dir(test_settings) if name.isupper()}
+    configuration["DATABASES"] = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": database_name}}
+    configuration["USE_TZ"] = True
+    settings.configure(**configuration)
+    django.setup()
+
+
+def populate(count):
+    from varsdaa.models import Display
+
+    Display.objects.bulk_create(
+        (
+            Display(
+                product_name=f"DELL P{3200 + i % 50}QE",
+                serial_number=str(800000000 + i),
+                alphanumeric_serial_number=f"8Y{i:07X}",
+            )
+            for i in range(count)
+        ),
+        batch_size=5000,
+    )
+
+
+def measure(label, count, lookups):
+    from varsdaa.ingest import display_identity_cache, display_identity_q, resolve_displays
+    from varsdaa.models import Display
+
+    step = max(count // lookups, 1)
+    reports = [
+        dict(
+            product_name=f"DELL P{3200 + i % 50}QE",
+            serial_number=str(800000000 + i),
+            alphanumeric_serial_number=f"8Y{i:07X}",
+        )
+        for i in range(0, count, step)
+    ]
+
+    print(f"== {label}")
+    print(Display.objects.filter(display_identity_q(reports[:1])).explain())
+    # Time the database, not the identity cache filled by the previous pass
+    display_identity_cache.clear()
+    start = time.perf_counter()
+    for report in reports:
+        identified, unknown = resolve_displays([report])
+        assert len(identified) == 1 and not unknown
+    elapsed = time.perf_counter() - start
+    assert display_identity_cache.cache_info().hits == 0
+    print(f"{len(reports)} lookups in {elapsed:.3f}s ({elapsed / len(reports) * 1000:.3f} ms/lookup)")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--displays", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(os.path.join(directory, "benchmark.sqlite3"))
+
+        from django.core.management import call_command
+
+        call_command("migrate", "varsdaa", "0004", verbosity=0)
+        populate(args.displays)
+        measure(f"{args.displays} displays, without identity indexes (0004)", args.displays, args.lookups)
+
+        call_command("migrate", "varsdaa", "0005", verbosity=0)
+        measure(f"{args.displays} displays, with identity indexes (0005)", args.displays, args.lookups)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark the `iommi` and `string` renderers of `varsdaa.map.Map`.
+
+Usage: python benchmarks/map_render.py [--shapes 100 1000 10000] [--repeat 3]
+
+Populates a throwaway SQLite database with one floor of desks and rooms per shape count and prints the time it takes
+to render the static shape layer with each renderer, and to render the whole map with a cold and a warm cache.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from display_lookup import setup  # noqa: E402
+
+RENDERERS = ("iommi", "string")
+
+
+def populate(shapes):
+    from varsdaa.models import Desk, Floor, Office, Room
+
+    office = Office.objects.create(display_name=f"Office with {shapes} shapes")
+    floor = Floor.objects.create(display_name="Floor", office=office)
+    Desk.objects.bulk_create(Desk(floor=floor, x=i % 1000, y=i // 1000) for i in range(shapes // 2))
+    Room.objects.bulk_create(
+        Room(display_name=f"Room {i}", floor=floor, x=i % 1000, y=i // 1000, width=20, height=10)
+        for i in range(shapes - shapes // 2)
+    )
+    return floor
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(floor, shapes, repeat):
+    from django.core.cache import cache
+    from django.test import RequestFactory
+
+    from varsdaa.map import Map
+    from varsdaa.models import Desk, Floor, Room
+
+    request = RequestFactory().get("/")
+
+    def bound(renderer):
+        return Map(
+            renderer=renderer,
+            floors_all=Floor.objects.filter(pk=floor.pk),
+            desks_all=Desk.objects.filter(floor=floor),
+            desks_marked=Desk.objects.filter(floor=floor)[:1],
+            rooms_all=Room.objects.filter(floor=floor),
+            rooms_marked=Room.objects.filter(floor=floor)[:1],
+        ).bind(request=request)
+
+    def cold(renderer):
+        cache.clear()
+        bound(renderer).__html__()
+
+    print(f"== {shapes} shapes")
+    for renderer in RENDERERS:
+        static = best_of(repeat, lambda: bound(renderer)._render_static_layers([floor.pk]))
+        full = best_of(repeat, lambda: cold(renderer))
+        print(f"{renderer:>6}: static layer {static * 1000:9.2f} ms, cold map {full * 1000:9.2f} ms")
+
+    bound("iommi").__html__()
+    warm = best_of(repeat, lambda: bound("iommi").__html__())
+    print(f"  warm cached map {warm * 1000:9.2f} ms")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", type=int, nargs="+", default=[100, 1000, 10_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(os.path.join(directory, "benchmark.sqlite3"))
+
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
+        for shapes in args.shapes:
+            measure(populate(shapes), shapes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
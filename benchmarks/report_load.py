@@ -0,0 +1,88 @@
+"""
+Load test the sync and async display report endpoints of a running server.
+
+Usage: python benchmarks/report_load.py --full-name "Putte Fisk" [--user-name puttefisk]
+           [--base-url http://localhost:8000] [--requests 2000] [--concurrency 50] [--displays-file displays.json]
+
+Run the server under WSGI (`manage.py runserver`, gunicorn) or ASGI (`uvicorn example.asgi:application`) and compare
+the throughput and latency of `/report_display/` and `/report_display_async/`. The user must exist, unknown users get
+404 responses, which are counted as errors. By default every request reports one display, which gets a registration
+URL unless it is registered.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+
+DEFAULT_DISPLAYS = [
+    {
+        "product_name": "DELL P3223QE",
+        "serial_number": "892416844",
+        "alphanumeric_serial_number": "8Y064P3",
+    }
+]
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as error:
+        error.read()
+        status = error.code
+    return status, time.perf_counter() - start
+
+
+def run(url, body, requests, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: post(url, body), range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    errors = Counter(status for status, _ in results if status != 200)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"== {url}")
+    print(f"{requests} requests, concurrency {concurrency}, {errors.total()} errors")
+    for status, count in sorted(errors.items()):
+        print(f"  HTTP {status}: {count}")
+    print(f"{requests / elapsed:.1f} requests/s")
+    print(
+        f"latency p50 {quantiles[49] * 1000:.1f} ms, p95 {quantiles[94] * 1000:.1f} ms, "
+        f"p99 {quantiles[98] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms"
+    )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--full-name", required=True)
+    parser.add_argument("--user-name", help="The user name the client reports, matched before the full name")
+    parser.add_argument("--displays-file", help="JSON file with the list of displays to report")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    displays = DEFAULT_DISPLAYS
+    if args.displays_file:
+        with open(args.displays_file) as f:
+            displays = json.load(f)
+    body = json.dumps({"user_name": args.user_name, "full_name": args.full_name, "displays": displays}).encode()
+
+    for path in ["/report_display/", "/report_display_async/"]:
+        url = args.base_url.rstrip("/") + path
+        post(url, body)  # Warm up
+        run(url, body, args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
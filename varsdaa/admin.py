@@ -2,6 +2,7 @@ from iommi.admin import Admin
 
 from varsdaa.iommi import Column, Menu
 from varsdaa.map import Map
+from varsdaa.models import Desk, Room
 
 
 def fail(x):
@@ -17,12 +18,27 @@ class VarsdaaAdmin(Admin):
 
         apps__varsdaa_user__include = True
         parts__list_varsdaa_user__columns__password__include = False
+        parts__create_varsdaa_user__fields__current_desk__include = False
+        parts__edit_varsdaa_user__fields__current_desk__include = False
 
         apps__varsdaa_office__include = True
         apps__varsdaa_floor__include = True
         parts__list_varsdaa_floor__columns__image = Column.image()
+        parts__create_varsdaa_floor__fields = dict(
+            image__include=False,
+            image_hash__include=False,
+            image_updated_at__include=False,
+            image_renditions__include=False,
+        )
+        parts__edit_varsdaa_floor__fields = dict(
+            image__include=False,
+            image_hash__include=False,
+            image_updated_at__include=False,
+            image_renditions__include=False,
+        )
 
         apps__varsdaa_room__include = True
+        parts__list_varsdaa_room__rows = Room.objects.select_related("floor")
         parts__edit_varsdaa_room__fields__map = Map(
             floors_marked=lambda instance, **_: [instance.floor] if instance.floor else [],
             rooms_all=lambda instance, **_: [instance],
@@ -30,6 +46,9 @@ class VarsdaaAdmin(Admin):
         )
 
         apps__varsdaa_desk__include = True
+        parts__list_varsdaa_desk__rows = Desk.objects.select_related("floor")
+        parts__create_varsdaa_desk__fields__current_occupant__include = False
+        parts__edit_varsdaa_desk__fields__current_occupant__include = False
         parts__edit_varsdaa_desk__fields__map = Map(
             floors_marked=lambda instance, **_: [instance.floor] if instance.floor else [],
             desks_all=lambda instance, **_: [instance],
@@ -8,6 +8,7 @@ class VarsdaaConfig(AppConfig):
     def ready(self):
         from iommi import register_style
 
+        import varsdaa.signals  # noqa: F401
         from varsdaa.style import varsdaa_style
 
         register_style('varsdaa_style', varsdaa_style)
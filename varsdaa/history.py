@@ -0,0 +1,137 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count
+
+from varsdaa.models import Desk, OccupancyInterval
+
+GROUPS = ("desk", "floor", "office")
+
+
+def interval_gap():
+    return timedelta(seconds=getattr(settings, "VARSDAA_OCCUPANCY_INTERVAL_GAP_SECONDS", 15 * 60))
+
+
+def interval_max_length():
+    return timedelta(seconds=getattr(settings, "VARSDAA_OCCUPANCY_INTERVAL_MAX_SECONDS", 24 * 60 * 60))
+
+
+def log_reports(entries):
+    """
+    Record reported displays in the occupancy history. `entries` is a list of `(resolved, user_pk, timestamp)` tuples,
+    `resolved` being a `ResolvedDisplay`. The open interval of a display is extended to `timestamp` if it is of the
+    same user and desk, ended at most `VARSDAA_OCCUPANCY_INTERVAL_GAP_SECONDS` before and doesn't get longer than
+    `VARSDAA_OCCUPANCY_INTERVAL_MAX_SECONDS`. Otherwise a new interval is started. Takes one query to read the open
+    intervals, and one each to extend and to start intervals.
+    """
+    if not entries:
+        return
+
+    gap = interval_gap()
+    max_length = interval_max_length()
+    latest = {}
+    for pk, display_id, user_id, desk_id, started_at, ended_at in (
+        OccupancyInterval.objects.filter(
+            display__in={resolved.pk for resolved, _, _ in entries},
+            ended_at__gte=min(timestamp for _, _, timestamp in entries) - gap,
+        )
+        .order_by("ended_at")
+        .values_list("pk", "display_id", "user_id", "desk_id", "started_at", "ended_at")
+    ):
+        latest[display_id] = OccupancyInterval(
+            pk=pk, user_id=user_id, desk_id=desk_id, started_at=started_at, ended_at=ended_at
+        )
+
+    extended = {}
+    started = {}
+    for resolved, user_pk, timestamp in entries:
+        interval = latest.get(resolved.pk)
+        if (
+            interval is not None
+            and (interval.user_id, interval.desk_id) == (user_pk, resolved.desk_id)
+            and timedelta(0) <= timestamp - interval.ended_at <= gap
+            and timestamp - interval.started_at <= max_length
+        ):
+            interval.ended_at = timestamp
+            extended[interval.pk] = interval
+        else:
+            started[resolved.pk] = OccupancyInterval(
+                display_id=resolved.pk,
+                user_id=user_pk,
+                desk_id=resolved.desk_id,
+                floor_id=resolved.floor_id,
+                office_id=resolved.office_id,
+                started_at=timestamp,
+                ended_at=timestamp,
+            )
+
+    OccupancyInterval.objects.bulk_update(extended.values(), ["ended_at"])
+    OccupancyInterval.objects.bulk_create(started.values())
+
+
+def intervals_at_desks(start, end):
+    """
+    The intervals of displays at a desk that overlap `start` to `end`. No interval is longer than
+    `VARSDAA_OCCUPANCY_INTERVAL_MAX_SECONDS`, so only the `started_at` index from that long before `start` is scanned.
+    """
+    return OccupancyInterval.objects.filter(
+        desk__isnull=False,
+        started_at__gte=start - interval_max_length(),
+        started_at__lt=end,
+        ended_at__gt=start,
+    )
+
+
+def merge_spans(spans):
+    """
+    Merge overlapping `(start, end)` spans, returning them sorted.
+    """
+    merged = []
+    for span_start, span_end in sorted(spans):
+        if merged and span_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+        else:
+            merged.append((span_start, span_end))
+    return merged
+
+
+def occupied_time(start, end, by="desk", pks=None):
+    """
+    How long each desk, floor or office, as given by `by`, was occupied between `start` and `end`, as a dict from
+    primary key to `timedelta`. Restricted to the primary keys `pks` if given. Overlapping intervals of the displays
+    of one desk are counted once, so a floor that was used at two desks for an hour was occupied for two hours.
+    """
+    assert by in GROUPS, by
+    intervals = intervals_at_desks(start, end)
+    if pks is not None:
+        intervals = intervals.filter(**{f"{by}__in": pks})
+
+    desks = defaultdict(list)
+    groups = {}
+    for desk_id, group_id, started_at, ended_at in intervals.values_list("desk_id", by, "started_at", "ended_at"):
+        desks[desk_id].append((max(started_at, start), min(ended_at, end)))
+        groups[desk_id] = group_id
+
+    result = defaultdict(timedelta)
+    for desk_id, spans in desks.items():
+        for span_start, span_end in merge_spans(spans):
+            result[groups[desk_id]] += span_end - span_start
+    return dict(result)
+
+
+def utilization(start, end, by="desk", pks=None):
+    """
+    The share of the time between `start` and `end` each desk, floor or office was occupied, between `0` and `1`. For
+    floors and offices, that's the occupied time of their desks over the time of all their desks. Desks, floors and
+    offices that weren't occupied at all are left out.
+    """
+    occupied = occupied_time(start, end, by=by, pks=pks)
+    if by == "desk":
+        desk_counts = dict.fromkeys(occupied, 1)
+    else:
+        lookup = "floor" if by == "floor" else "floor__office"
+        desks = Desk.objects.filter(**{f"{lookup}__in": occupied}).values(lookup).annotate(count=Count("pk"))
+        desk_counts = {row[lookup]: row["count"] for row in desks}
+    span = end - start
+    return {pk: occupied[pk] / (span * desk_counts[pk]) for pk in occupied if desk_counts.get(pk)}
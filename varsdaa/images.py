@@ -0,0 +1,180 @@
+import io
+import logging
+import re
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from varsdaa.models import IMAGE_TYPES, Floor, floor_image_name
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, without it floor images are only served in their original size
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Max width of each derivative, the map draws floors 1000 pixels wide and lists show thumbnails 100 pixels high
+DEFAULT_SIZES = {"thumbnail": 400, "map": 1000}
+# In order of preference, the last one is sent to clients that don't explicitly accept the others
+DEFAULT_FORMATS = ["AVIF", "WEBP", "PNG"]
+CHUNK_SIZE = 64 * 1024
+
+range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """
+    The `(start, end)` byte positions, inclusive, of a `Range` header with a single range. `None` if there's no range
+    to honor, in which case the whole file is sent. Raises `ValueError` if the range can't be satisfied.
+    """
+    match = range_re.match(header or "")
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    start, end = match.groups()
+    if start == "":
+        # The last `end` bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def read_range(file, start, end):
+    with file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request, file, size, etag, content_type):
+    """
+    Stream `file`, or the byte range of it asked for by a `Range` header.
+    """
+    byte_range = None
+    if etag is None or request.headers.get("If-Range", etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            file.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(file, start, end), status=206, content_type=content_type)
+        response["Content-Length"] = end - start + 1
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def pick_rendition(request, renditions):
+    """
+    The `(content_type, name)` of the first of `renditions` the client accepts. Newer formats must be listed in the
+    `Accept` header explicitly, the last rendition is always acceptable.
+    """
+    accept = request.headers.get("Accept", "")
+    *preferred, fallback = renditions.items()
+    for content_type, name in preferred:
+        if content_type in accept:
+            return content_type, name
+    return fallback
+
+
+def create_image_derivatives(floor, image):
+    """
+    Store the derivatives of a floor's `image` in `VARSDAA_FLOOR_IMAGE_SIZES` and `VARSDAA_FLOOR_IMAGE_FORMATS` that
+    this installation of Pillow can write, and record them in `floor.image_renditions`. Without Pillow, there are no
+    derivatives and the original image is served for every size.
+    """
+    if Image is None or not image:
+        return
+
+    Image.init()
+    storage = Floor._meta.get_field("image").storage
+    try:
+        original = Image.open(io.BytesIO(image))
+        original.load()
+    except (OSError, Image.DecompressionBombError):
+        logger.warning("Can't create derivatives of the image of %r", floor, exc_info=True)
+        return
+
+    with original:
+        for size, width in getattr(settings, "VARSDAA_FLOOR_IMAGE_SIZES", DEFAULT_SIZES).items():
+            resized = original.copy()
+            resized.thumbnail((width, width * 10))
+            renditions = {}
+            for image_format in getattr(settings, "VARSDAA_FLOOR_IMAGE_FORMATS", DEFAULT_FORMATS):
+                extension = image_format.lower()
+                if image_format not in Image.SAVE or extension not in IMAGE_TYPES:
+                    continue
+                name = floor_image_name(floor.image_hash, extension, size)
+                if not storage.exists(name):
+                    output = io.BytesIO()
+                    converted = resized if resized.mode in ("RGB", "RGBA") else resized.convert("RGBA")
+                    converted.save(output, format=image_format)
+                    storage.save(name, ContentFile(output.getvalue()))
+                renditions[IMAGE_TYPES[extension]] = name
+            if renditions:
+                floor.image_renditions[size] = renditions
+
+
+def floor_image_response(request, floor_pk, image_hash=None):
+    """
+    The image of a floor, or with a `size` parameter one of its derivatives, answering conditional requests from
+    `Floor.image_hash` and `Floor.image_updated_at` without touching the storage. Under a versioned URL, with
+    `image_hash`, the response can be cached forever.
+    """
+    floor = get_object_or_404(
+        Floor.objects.only("image_hash", "image_updated_at", "image_renditions"),
+        pk=floor_pk,
+    )
+    if image_hash is not None and image_hash != floor.image_hash:
+        return HttpResponseRedirect(floor.get_image_url(request.GET.get("size")))
+
+    size = request.GET.get("size")
+    if size not in floor.image_renditions:
+        size = "original"
+    renditions = floor.image_renditions.get(size)
+    content_type, name = pick_rendition(request, renditions) if renditions else ("image/png", None)
+
+    etag = None
+    if floor.image_hash:
+        etag = f'"{floor.image_hash}"' if size == "original" else f'"{floor.image_hash}-{size}-{content_type[6:]}"'
+    last_modified = int(floor.image_updated_at.timestamp()) if floor.image_updated_at else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if name:
+            storage = Floor._meta.get_field("image").storage
+            response = file_response(request, storage.open(name, "rb"), storage.size(name), etag, content_type)
+        else:
+            response = HttpResponse(content_type=content_type)
+
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    if renditions and len(renditions) > 1:
+        patch_vary_headers(response, ["Accept"])
+    if image_hash:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
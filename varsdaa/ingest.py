@@ -0,0 +1,407 @@
+import logging
+from collections import defaultdict
+from copy import copy
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from varsdaa.cache import LRUCache
+from varsdaa.history import log_reports
+from varsdaa.models import Display, User
+from varsdaa.occupancy import refresh_occupancy, touch_occupancy
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_FIELDS = ("alphanumeric_serial_number", "serial_number")
+
+display_identity_cache = LRUCache(
+    maxsize=getattr(settings, "VARSDAA_DISPLAY_CACHE_SIZE", 10_000),
+    ttl=getattr(settings, "VARSDAA_DISPLAY_CACHE_TTL", 300),
+)
+
+user_identity_cache = LRUCache(
+    maxsize=getattr(settings, "VARSDAA_USER_CACHE_SIZE", 10_000),
+    ttl=getattr(settings, "VARSDAA_USER_CACHE_TTL", 300),
+)
+
+
+class ResolvedDisplay(NamedTuple):
+    pk: int
+    desk_id: int | None
+    floor_id: int | None
+    office_id: int | None
+    user_id: int | None
+    user_updated_at: datetime | None
+
+
+def normalize_display_report(display_report):
+    serial_number = display_report.get("serial_number", None)
+    alphanumeric_serial_number = display_report.get("alphanumeric_serial_number", None)
+
+    # Hack to be compatible with Windows clients reporting alphanumeric_serial_number as serial_number
+    if not alphanumeric_serial_number and serial_number and not serial_number.isdigit():
+        display_report["alphanumeric_serial_number"] = serial_number
+        del display_report["serial_number"]
+
+    return display_report
+
+
+def client_identity(report):
+    return report.get("user_name") or None, report.get("full_name") or None
+
+
+def resolve_users(identities):
+    """
+    Find the users clients report as `identities`, `(user_name, full_name)` pairs as given by `client_identity`, from
+    `user_identity_cache` or else with a single query. The unique `User.client_name` is matched against the user name
+    first, then the full name. A user without a client name gets their name as client name on their first report,
+    provided nobody else has the same name. A full name claimed by one user is refused while other users of that name
+    have no client name, their reports would otherwise end up on the user who claimed it; set the client name of
+    namesakes to the user name their client reports to tell them apart. Returns a dict from identity to user, leaving
+    out unknown and ambiguous identities.
+    """
+    users = {}
+    missing = set()
+    for identity in identities:
+        if not identity[1]:
+            continue
+        user = user_identity_cache.get(identity)
+        if user is None:
+            missing.add(identity)
+        elif user:
+            users[identity] = copy(user)
+
+    if not missing:
+        return users
+
+    full_names = {full_name for _, full_name in missing}
+    claimed = {}
+    namesakes = defaultdict(list)
+    for user in User.objects.filter(
+        Q(client_name__in=full_names | {user_name for user_name, _ in missing if user_name})
+        | Q(name__in=full_names, client_name=None)
+    ):
+        if user.client_name is None:
+            namesakes[user.name].append(user)
+        else:
+            claimed[user.client_name] = user
+
+    for identity in missing:
+        user_name, full_name = identity
+        user = claimed.get(user_name) if user_name else None
+        if user is None and full_name in claimed:
+            if namesakes[full_name]:
+                logger.warning("Not resolving %r, users without a client name share the name", identity)
+            else:
+                user = claimed[full_name]
+        elif user is None and len(namesakes[full_name]) == 1:
+            user = namesakes.pop(full_name)[0]
+            user.client_name = full_name
+            user.save(update_fields=["client_name"])
+            claimed[full_name] = user
+
+        user_identity_cache.set(identity, user or False)
+        if user:
+            users[identity] = copy(user)
+
+    return users
+
+
+def resolve_user(identity):
+    return resolve_users([identity]).get(identity)
+
+
+async def aresolve_user(identity):
+    """
+    Async version of `resolve_user`, only hitting the database on a cache miss.
+    """
+    user = user_identity_cache.get(identity)
+    if user is None:
+        return await sync_to_async(resolve_user)(identity)
+    return copy(user) if user else None
+
+
+def display_identity(display_report):
+    return (
+        display_report["product_name"],
+        display_report.get("alphanumeric_serial_number") or None,
+        display_report.get("serial_number") or None,
+    )
+
+
+def display_identity_q(display_reports):
+    q = Q()
+    for display_report in display_reports:
+        for field in IDENTITY_FIELDS:
+            if value := display_report.get(field):
+                q |= Q(product_name=display_report["product_name"], **{field: value})
+    return q
+
+
+def _resolve_from_cache(display_reports):
+    identified = {}
+    missing = []
+    for display_report in display_reports:
+        identity = display_identity(display_report)
+        resolved = display_identity_cache.get(identity)
+        if resolved is None:
+            missing.append(display_report)
+        else:
+            identified[identity] = resolved
+    return identified, missing
+
+
+def _display_rows(display_reports):
+    q = display_identity_q(display_reports)
+    if not q:
+        return Display.objects.none()
+    return Display.objects.filter(q).values_list(
+        "pk",
+        "product_name",
+        *IDENTITY_FIELDS,
+        "desk_id",
+        "desk__floor_id",
+        "desk__floor__office_id",
+        "user_id",
+        "user_updated_at",
+    )
+
+
+def _resolve_from_rows(display_reports, rows, identified):
+    candidates = {}
+    for pk, product_name, alphanumeric_serial_number, serial_number, *rest in rows:
+        resolved = ResolvedDisplay(pk, *rest)
+        if alphanumeric_serial_number:
+            candidates["alphanumeric_serial_number", product_name, alphanumeric_serial_number] = resolved
+        if serial_number:
+            candidates["serial_number", product_name, serial_number] = resolved
+
+    unknown = []
+    for display_report in display_reports:
+        for field in IDENTITY_FIELDS:
+            resolved = candidates.get((field, display_report["product_name"], display_report.get(field)))
+            if resolved is not None:
+                identity = display_identity(display_report)
+                display_identity_cache.set(identity, resolved)
+                identified[identity] = resolved
+                break
+        else:
+            unknown.append(display_report)
+
+    return identified, unknown
+
+
+def resolve_displays(display_reports):
+    """
+    Look up the displays of a report, from `display_identity_cache` or else with a single query.
+
+    A display is matched on `(product_name, alphanumeric_serial_number)` first and on `(product_name, serial_number)`
+    second. Empty serial numbers never match. Returns a tuple of a dict from display identity to `ResolvedDisplay` and
+    a list of the display reports that matched no display.
+    """
+    identified, missing = _resolve_from_cache(display_reports)
+    rows = list(_display_rows(missing))
+    return _resolve_from_rows(missing, rows, identified)
+
+
+async def aresolve_displays(display_reports):
+    """
+    Async version of `resolve_displays`.
+    """
+    identified, missing = _resolve_from_cache(display_reports)
+    rows = [row async for row in _display_rows(missing)]
+    return _resolve_from_rows(missing, rows, identified)
+
+
+def report_debounce():
+    return timedelta(seconds=getattr(settings, "VARSDAA_REPORT_DEBOUNCE_SECONDS", 60))
+
+
+def _pending_writes(user, identified, timestamp):
+    debounce = report_debounce()
+    stale = {
+        identity: resolved
+        for identity, resolved in identified.items()
+        if resolved.user_id != user.pk
+        or resolved.user_updated_at is None
+        or timestamp - resolved.user_updated_at >= debounce
+    }
+
+    offices = [resolved.office_id for resolved in identified.values() if resolved.desk_id]
+    office_id = offices[-1] if offices else user.office_id
+
+    return stale, office_id
+
+
+def _previous_users(display_pks):
+    """
+    The users of displays before they are written, from the database and locked until the end of the transaction. The
+    cache of this process may not have seen another process connect a display to someone else.
+    """
+    return dict(Display.objects.select_for_update().filter(pk__in=display_pks).values_list("pk", "user_id"))
+
+
+def _write_occupancy(writes, previous):
+    """
+    Update the occupancy after displays were written, `writes` being `(resolved, user_pk, timestamp)` tuples and
+    `previous` the `_previous_users` of the displays. A display reported again by its user only moves
+    `Occupancy.last_seen` forward, a display that changed hands refreshes the users and desks involved.
+    """
+    user_pks = set()
+    desk_pks = set()
+    seen = {}
+    for resolved, user_pk, timestamp in writes:
+        if previous.get(resolved.pk) == user_pk:
+            if resolved.desk_id is not None:
+                seen[resolved.desk_id, user_pk] = timestamp
+        else:
+            user_pks |= {user_pk, previous.get(resolved.pk)}
+            desk_pks.add(resolved.desk_id)
+    for desk_pk, user_pk in touch_occupancy(seen):
+        user_pks.add(user_pk)
+        desk_pks.add(desk_pk)
+    refresh_occupancy(user_pks, desk_pks)
+
+
+def _write(user, stale, office_id, timestamp):
+    with transaction.atomic():
+        if stale:
+            display_pks = {resolved.pk for resolved in stale.values()}
+            previous = _previous_users(display_pks)
+            Display.objects.filter(pk__in=display_pks).update(user=user, user_updated_at=timestamp)
+            writes = [(resolved, user.pk, timestamp) for resolved in stale.values()]
+            _write_occupancy(writes, previous)
+            log_reports(writes)
+        if office_id != user.office_id:
+            user.office_id = office_id
+            user.save(update_fields=["office", "office_updated_at"])
+
+    for identity, resolved in stale.items():
+        display_identity_cache.set(identity, resolved._replace(user_id=user.pk, user_updated_at=timestamp))
+
+
+def disconnect_displays(users):
+    """
+    Disconnect `users` from all their displays. Returns whether they had any.
+    """
+    with transaction.atomic():
+        desk_pks = list(Display.objects.filter(user__in=users).values_list("desk_id", flat=True))
+        if not desk_pks:
+            return False
+        Display.objects.filter(user__in=users).update(user=None)
+        refresh_occupancy(user_pks=[user.pk for user in users], desk_pks=desk_pks)
+
+    display_identity_cache.clear()
+    return True
+
+
+def display_user_ttl():
+    return timedelta(seconds=getattr(settings, "VARSDAA_DISPLAY_USER_TTL", 24 * 60 * 60))
+
+
+def expire_displays(ttl=None, chunk_size=1000, now=None):
+    """
+    Disconnect the displays that weren't reported for `ttl`, by default `VARSDAA_DISPLAY_USER_TTL`, in chunks of
+    `chunk_size`, oldest first. Each chunk is found through the index on `Display.user_updated_at` and written in its
+    own transaction, so the table is never locked for long. Returns the number of disconnected displays.
+    """
+    cutoff = (now or timezone.now()) - (display_user_ttl() if ttl is None else ttl)
+    expired = Display.objects.filter(user__isnull=False, user_updated_at__lt=cutoff)
+    count = 0
+    while rows := list(expired.order_by("user_updated_at").values_list("pk", "user_id", "desk_id")[:chunk_size]):
+        with transaction.atomic():
+            # A display reported since the chunk was read isn't expired anymore
+            count += expired.filter(pk__in=[pk for pk, _, _ in rows]).update(user=None)
+            refresh_occupancy(
+                user_pks=[user_id for _, user_id, _ in rows],
+                desk_pks=[desk_id for _, _, desk_id in rows],
+            )
+
+    if count:
+        display_identity_cache.clear()
+    return count
+
+
+def apply_report(user, identified, timestamp=None):
+    """
+    Write the outcome of a report: connect the identified displays to the user and move the user to the office of
+    their desk. A report without identified displays disconnects the user from all displays.
+
+    Only changes are written. A display already connected to the user isn't written to at all if the previous report
+    is more recent than `VARSDAA_REPORT_DEBOUNCE_SECONDS`.
+    """
+    if timestamp is None:
+        timestamp = timezone.now()
+
+    if not identified:
+        disconnect_displays([user])
+        return
+
+    stale, office_id = _pending_writes(user, identified, timestamp)
+    if stale or office_id != user.office_id:
+        _write(user, stale, office_id, timestamp)
+
+
+async def aapply_report(user, identified, timestamp=None):
+    """
+    Async version of `apply_report`. Django transactions don't work in async code, so the writes, when there are any,
+    run in a thread.
+    """
+    if timestamp is None:
+        timestamp = timezone.now()
+
+    if not identified:
+        if await Display.objects.filter(user=user).aexists():
+            await sync_to_async(disconnect_displays)([user])
+        return
+
+    stale, office_id = _pending_writes(user, identified, timestamp)
+    if stale or office_id != user.office_id:
+        await sync_to_async(_write)(user, stale, office_id, timestamp)
+
+
+def apply_reports(reports):
+    """
+    Write the outcome of the reports of several users, like `apply_report` does for one, but with a constant number of
+    queries. `reports` is a list of `(user, identified, timestamp)` tuples.
+    """
+    disconnected = []
+    displays = {}
+    users = {}
+    written = []
+    logged = []
+    for user, identified, timestamp in reports:
+        if not identified:
+            disconnected.append(user)
+            continue
+
+        stale, office_id = _pending_writes(user, identified, timestamp)
+        for resolved in stale.values():
+            displays[resolved.pk] = Display(pk=resolved.pk, user=user, user_updated_at=timestamp)
+            logged.append((resolved, user.pk, timestamp))
+        if office_id != user.office_id:
+            # A copy, the report must still apply on its own if the batch fails
+            users[user.pk] = copy(user)
+            users[user.pk].office_id = office_id
+            users[user.pk].office_updated_at = timestamp
+        written.append((user, stale, timestamp))
+
+    with transaction.atomic():
+        if disconnected:
+            disconnect_displays(disconnected)
+        previous = _previous_users(displays.keys())
+        Display.objects.bulk_update(displays.values(), ["user", "user_updated_at"])
+        if users:
+            User.objects.bulk_update(users.values(), ["office", "office_updated_at"])
+            user_identity_cache.clear()
+        _write_occupancy(logged, previous)
+        log_reports(logged)
+
+    for user, stale, timestamp in written:
+        for identity, resolved in stale.items():
+            display_identity_cache.set(identity, resolved._replace(user_id=user.pk, user_updated_at=timestamp))
@@ -23,8 +23,8 @@ class Column(iommi.Column):
     @with_defaults(
         cell__value=lambda row, **_: row,
         cell__format=lambda value, **_: format_html(
-            '<img  style="height:100px;" src="{}image/" />',
-            value.get_absolute_url(),
+            '<img  style="height:100px;" src="{}" />',
+            value.get_thumbnail_url(),
         ),
     )
     def image(cls, **kwargs):
@@ -61,6 +61,12 @@ class Page(iommi.Page):
                 fill: rgba(0, 255, 0, 0.1)
             }
 
+            .heat-0 { fill: rgba(255, 237, 160, 0.6); }
+            .heat-1 { fill: rgba(254, 178, 76, 0.6); }
+            .heat-2 { fill: rgba(253, 141, 60, 0.6); }
+            .heat-3 { fill: rgba(240, 59, 32, 0.6); }
+            .heat-4 { fill: rgba(189, 0, 38, 0.6); }
+
             .hover {
                 fill: rgba(200, 200, 200, 0.2);
 
@@ -87,7 +93,7 @@ class Field(iommi.Field):
                     {{ field.label }}
                     {{ field.input }}
                     {% if field.value %}
-                    <img class="mt-3 mb-3" style="height:100px" src="/floor/{{ field.form.instance.pk }}/image/" />
+                    <img class="mt-3 mb-3" style="height:100px" src="{{ field.form.instance.get_thumbnail_url }}" />
                     {% endif %}
                     {{ field.help }}
                 {{ field.errors }}
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from varsdaa.images import Image, create_image_derivatives
+from varsdaa.models import IMAGE_TYPES, Floor, image_extension
+
+
+class Command(BaseCommand):
+    help = "Create the thumbnail and map sized derivatives of the floor images that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Also floors that already have derivatives")
+
+    def handle(self, *args, all=False, **options):
+        if Image is None:
+            self.stderr.write("Pillow isn't installed, no derivatives can be created.")
+            return
+
+        floors = Floor.objects.exclude(image="")
+        for floor in floors.iterator():
+            if not all and floor.image_renditions.keys() - {"original"}:
+                continue
+
+            with floor.image.open("rb") as file:
+                image = file.read()
+            floor.image_renditions = {"original": {IMAGE_TYPES[image_extension(image)]: floor.image.name}}
+            create_image_derivatives(floor, image)
+            floor.save(update_fields=["image_renditions"])
+            self.stdout.write(f"{floor!r}: {', '.join(floor.image_renditions)}")
@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from varsdaa.ingest import expire_displays
+
+
+class Command(BaseCommand):
+    help = "Disconnect users from the displays they haven't reported for VARSDAA_DISPLAY_USER_TTL seconds."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ttl", type=int, help="Seconds without a report, overrides the setting")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Displays to update per statement")
+
+    def handle(self, *args, ttl=None, chunk_size=1000, **options):
+        count = expire_displays(ttl=None if ttl is None else timedelta(seconds=ttl), chunk_size=chunk_size)
+        self.stdout.write(f"Disconnected {count} displays")
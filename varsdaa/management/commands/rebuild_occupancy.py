@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from varsdaa.occupancy import rebuild_occupancy
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the current desk of every user, the current occupant of every desk and the occupancy snapshot from "
+        "the displays."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rebuild_occupancy()
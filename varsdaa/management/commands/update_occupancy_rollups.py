@@ -0,0 +1,20 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from varsdaa.rollups import pending_rollup_start, update_rollups
+
+
+class Command(BaseCommand):
+    help = "Aggregate the occupancy history into hourly and daily rollups, from the last day already rolled up."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=date.fromisoformat, help="Recompute from this day, as YYYY-MM-DD")
+
+    def handle(self, *args, since=None, **options):
+        start = since or pending_rollup_start()
+        if start is None:
+            self.stdout.write("No occupancy history to roll up")
+            return
+        update_rollups(start)
+        self.stdout.write(f"Rolled up occupancy since {start}")
@@ -1,17 +1,139 @@
+import hashlib
+import time
+from collections import defaultdict
 from collections.abc import Iterable
 
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
-from django.utils.html import format_html
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, QuerySet
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
 from iommi import Asset, Fragment, html
+from iommi.attrs import render_class
+from iommi.base import values
 from iommi.declarative.namespace import Namespace
 from iommi.endpoint import DISPATCH_PREFIX
 from iommi.evaluate import evaluate_strict
-from iommi.refinable import Refinable
+from iommi.refinable import EvaluatedRefinable, Refinable
 from iommi.shortcut import with_defaults
 from iommi.table import params_of_request
 
-from varsdaa.models import Desk, Floor, Room
+from varsdaa.images import floor_image_response
+from varsdaa.models import Desk, Floor, Occupancy, Room
+
+
+def _pks(objects):
+    """
+    The set of primary keys of `objects`, which can be an iterable of model instances or a queryset. Only the primary
+    keys are fetched from a queryset that isn't evaluated already.
+    """
+    if objects is None:
+        return set()
+    if isinstance(objects, QuerySet) and objects._result_cache is None:
+        return set(objects.values_list("pk", flat=True))
+    return {obj.pk for obj in objects}
+
+
+HEAT_LEVELS = 5
+
+
+def _floor_version_key(floor_pk):
+    return f"varsdaa:map:floor:{floor_pk}:version"
+
+
+def bump_floor_version(floor_pk):
+    """
+    Invalidate the cached map shapes of a floor. Returns the new version.
+    """
+    version = time.time_ns()
+    cache.set(_floor_version_key(floor_pk), version, timeout=None)
+    return version
+
+
+def floor_version(floor_pk):
+    return cache.get(_floor_version_key(floor_pk)) or bump_floor_version(floor_pk)
+
+
+def floor_geometry(floor_pk):
+    """
+    The shapes of a floor as packed arrays: `[pk, x, y]` for each desk and `[pk, x, y, width, height]` for each room.
+    """
+    desks = Desk.objects.filter(floor_id=floor_pk, x__isnull=False, y__isnull=False)
+    rooms = Room.objects.filter(floor_id=floor_pk, x__isnull=False, y__isnull=False)
+    return {
+        "desks": list(desks.values_list("pk", "x", "y")),
+        "rooms": list(rooms.values_list("pk", "x", "y", "width", "height")),
+    }
+
+
+def json_response_with_etag(request, data):
+    """
+    A JSON response with an ETag of its content, or a 304 Not Modified if the client already has it.
+    """
+    response = JsonResponse(data)
+    etag = f'"{hashlib.md5(response.content, usedforsecurity=False).hexdigest()}"'
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+def _split_class(markup, class_name):
+    head, tail = markup.split(f' class="{class_name}"', 1)
+    return head, tail
+
+
+def _overlay(parts, classes):
+    head, tail = parts
+    return f'{head} class="{render_class(classes)}"{tail}'
+
+
+def _render_room_shapes(rooms):
+    # Same markup as Map._render_room_shapes, attributes in the order iommi renders them
+    for floor_id, pk, x, y, width, height in rooms:
+        attrs = " ".join(
+            f'{name}="{value}"'
+            for name, value in (("data-room", pk), ("height", height), ("width", width), ("x", x), ("y", y))
+            if value is not None
+        )
+        yield floor_id, pk, (f'<a href="{escape(Room(pk=pk).get_absolute_url())}"><rect', f" {attrs}></rect></a>")
+
+
+def _render_desk_shapes(desks):
+    # Same markup as Map._render_desk_shapes, attributes in the order iommi renders them
+    for floor_id, pk, x, y in desks:
+        yield (
+            floor_id,
+            pk,
+            (
+                f'<a href="{escape(Desk(pk=pk).get_absolute_url())}"><circle',
+                f' cx="{x}" cy="{y}" data-desk="{pk}" r="10"></circle></a>',
+            ),
+        )
+
+
+def _restrict(queryset, objects):
+    """
+    Restrict `queryset` to `objects`, which can be an iterable of model instances or a queryset. A queryset that isn't
+    evaluated already is composed as a subquery. `None` or an empty iterable doesn't restrict anything.
+    """
+    if isinstance(objects, QuerySet) and objects._result_cache is None:
+        return queryset.filter(pk__in=objects.values("pk"))
+    if pks := _pks(objects):
+        return queryset.filter(pk__in=pks)
+    return queryset
+
+
+def _on_floor(objects, shown):
+    """
+    The shapes of `objects` among `shown`, composed as a subquery so that a map of one floor only fetches the marked
+    shapes of that floor. Anything but an unevaluated queryset is returned as is.
+    """
+    if isinstance(objects, QuerySet) and objects._result_cache is None:
+        return shown.filter(pk__in=objects.values("pk"))
+    return objects
 
 
 @with_defaults(floors_all=lambda **_: Floor.objects.all().order_by("-display_name"))
@@ -19,6 +141,10 @@ class Map(Fragment):
     class Meta:
         assets__map_js = Asset.js(children__content__template="js/map.js")
 
+        @staticmethod
+        def renderer(**_):
+            return getattr(settings, "VARSDAA_MAP_RENDERER", "iommi")
+
         svg__attrs = {
             "xmlns": "http://www.w3.org/2000/svg",
             "width": 1000,
@@ -27,119 +153,249 @@ class Map(Fragment):
         }
 
         @staticmethod
-        def endpoints__image__func(value, fragment, **_):
-            floor = get_object_or_404(Floor, pk=value)
-            return HttpResponse(floor.image, content_type="image/png")
+        def endpoints__image__func(value, request, **_):
+            return floor_image_response(request, value)
+
+        @staticmethod
+        def endpoints__state__func(value, fragment, request, **_):
+            try:
+                floor_pk = int(value)
+            except ValueError:
+                return HttpResponseBadRequest(f"Invalid floor: {value!r}")
+            return json_response_with_etag(request, fragment.state(floor_pk))
 
     svg: Namespace = Refinable()
+    renderer: str = EvaluatedRefinable()
     desks_all: Iterable[Desk] | None = Refinable()
     desks_marked: Iterable[Desk] | None = Refinable()
     rooms_all: Iterable[Room] | None = Refinable()
     rooms_marked: Iterable[Room] | None = Refinable()
     floors_all: Iterable[Room] | None = Refinable()
     floors_marked: Iterable[Room] | None = Refinable()
+    # Desk pk to how used the desk is, between 0 and 1, drawn as one of HEAT_LEVELS heat-<level> classes
+    heat: dict[int, float] | None = Refinable()
 
     def render_text_or_children(self, context=None):
         floors_all = evaluate_strict(self.floors_all, **self.iommi_evaluate_parameters()) or []
-        floors_marked = evaluate_strict(self.floors_marked, **self.iommi_evaluate_parameters()) or []
+        floors_marked = _pks(evaluate_strict(self.floors_marked, **self.iommi_evaluate_parameters()))
+        desks_by_floor, desks_marked = self._desks_by_floor()
+        rooms_by_floor, rooms_marked = self._rooms_by_floor()
+        heat = self._heat_levels()
+        floors = [
+            floor
+            for floor in floors_all
+            if desks_by_floor[floor.pk] or rooms_by_floor[floor.pk] or floor.pk in floors_marked
+        ]
+        client = self.renderer == "client"
+        layers = {} if client else self._static_layers([floor.pk for floor in floors])
 
         fragments = []
         request = self.get_request()
-        for floor in floors_all:
-            shapes = self._render_desk_shapes(floor) + self._render_room_shapes(floor)
-            if not shapes and floor not in floors_marked:
-                continue
-
+        for floor in floors:
             params = params_of_request(request)
-            params[DISPATCH_PREFIX + self.endpoints.image.iommi_path] = floor.pk
-            shapes.insert(
-                0,
-                html.image(
-                    attrs__width=1000,
-                    attrs__href="?" + params.urlencode(),
-                ),
+            if floor.image_hash:
+                image_url = floor.get_image_url("map")
+            else:
+                image_params = params.copy()
+                image_params[DISPATCH_PREFIX + self.endpoints.image.iommi_path] = floor.pk
+                image_url = "?" + image_params.urlencode()
+            image = html.image(
+                attrs__width=1000,
+                attrs__href=image_url,
             )
 
-            fragments.append(
-                html.svg(*shapes, **self.svg).bind(request=request),
-            )
+            if client:
+                # Drawn by map.js from the floor geometry and the state endpoint
+                params[DISPATCH_PREFIX + self.endpoints.state.iommi_path] = floor.pk
+                svg = Namespace(
+                    self.svg,
+                    attrs={
+                        "data-map-geometry": reverse("floor_map", kwargs={"floor_pk": floor.pk}),
+                        "data-map-state": "?" + params.urlencode(),
+                    },
+                )
+                fragments.append(html.svg(image, **svg).bind(request=request))
+                continue
+
+            desks = desks_by_floor[floor.pk]
+            rooms = rooms_by_floor[floor.pk]
+            layer = layers[floor.pk]
+            if not layer["desks"].keys() >= {pk for pk, _ in desks} or not layer["rooms"].keys() >= set(rooms):
+                # Shapes added by another process that didn't bump the version of a shared cache
+                layer = self._static_layers([floor.pk], refresh=True)[floor.pk]
+
+            shapes = [
+                _overlay(
+                    layer["desks"][pk],
+                    {
+                        "desk": True,
+                        "marked": pk in desks_marked,
+                        "connected": connected,
+                        f"heat-{heat.get(pk)}": pk in heat,
+                    },
+                )
+                for pk, connected in desks
+                if pk in layer["desks"]
+            ]
+            shapes += [
+                _overlay(layer["rooms"][pk], {"room": True, "marked": pk in rooms_marked})
+                for pk in rooms
+                if pk in layer["rooms"]
+            ]
+
+            fragments.append(html.svg(image, mark_safe("".join(shapes)), **self.svg).bind(request=request))
 
         return format_html("{}\n" * len(fragments), *fragments)
 
-    def _render_room_shapes(self, floor):
-        rooms_all = evaluate_strict(self.rooms_all, **self.iommi_evaluate_parameters()) or []
+    def state(self, floor_pk):
+        """
+        The desks and rooms to show on a floor and which of them are marked or connected, as lists of primary keys.
+        """
+        desks_by_floor, desks_marked = self._desks_by_floor(floor_pk)
+        rooms_by_floor, rooms_marked = self._rooms_by_floor(floor_pk)
+        desks = desks_by_floor[floor_pk]
+        rooms = rooms_by_floor[floor_pk]
+        heat = self._heat_levels()
+        return {
+            "desks": [pk for pk, _ in desks],
+            "rooms": rooms,
+            "marked_desks": [pk for pk, _ in desks if pk in desks_marked],
+            "marked_rooms": [pk for pk in rooms if pk in rooms_marked],
+            "connected_desks": [pk for pk, connected in desks if connected],
+            "heat": {pk: heat[pk] for pk, _ in desks if pk in heat},
+        }
+
+    def _heat_levels(self):
+        heat = evaluate_strict(self.heat, **self.iommi_evaluate_parameters()) or {}
+        return {pk: min(int(value * HEAT_LEVELS), HEAT_LEVELS - 1) for pk, value in heat.items()}
+
+    def _rooms_by_floor(self, floor_pk=None):
+        rooms_all = evaluate_strict(self.rooms_all, **self.iommi_evaluate_parameters())
+        shown = Room.objects.filter(x__isnull=False, y__isnull=False)
+        if floor_pk is not None:
+            shown = shown.filter(floor_id=floor_pk)
         rooms_marked = evaluate_strict(self.rooms_marked, **self.iommi_evaluate_parameters())
+        rooms_marked = _pks(rooms_marked if floor_pk is None else _on_floor(rooms_marked, shown))
+        rooms_by_floor = defaultdict(list)
         if not rooms_marked:
-            return []
-
-        rooms = Room.objects.filter(
-            pk__in={room.pk for room in list(rooms_all) or Room.objects.all()},
-        ).select_related(
-            "floor",
-        )
+            return rooms_by_floor, rooms_marked
 
-        shapes = []
-        for room in rooms:
-            if room.floor != floor:
-                continue
-            if room.x is None or room.y is None:
-                continue
-            shapes.append(
-                html.a(
-                    html.rect(
-                        attrs={
-                            "class": {
-                                "room": True,
-                                "marked": bool(room in rooms_marked),
-                            },
-                            "data-room": room.pk,
-                            "x": room.x,
-                            "y": room.y,
-                            "width": room.width,
-                            "height": room.height,
-                        },
-                    ),
-                    attrs__href=room.get_absolute_url(),
-                ),
-            )
-        return shapes
+        rooms = _restrict(shown, rooms_all)
+        for pk, floor_id in rooms.values_list("pk", "floor_id"):
+            rooms_by_floor[floor_id].append(pk)
+        return rooms_by_floor, rooms_marked
 
-    def _render_desk_shapes(self, floor):
-        desks_all = evaluate_strict(self.desks_all, **self.iommi_evaluate_parameters()) or []
+    def _desks_by_floor(self, floor_pk=None):
+        desks_all = evaluate_strict(self.desks_all, **self.iommi_evaluate_parameters())
+        shown = Desk.objects.filter(x__isnull=False, y__isnull=False)
+        if floor_pk is not None:
+            shown = shown.filter(floor_id=floor_pk)
         desks_marked = evaluate_strict(self.desks_marked, **self.iommi_evaluate_parameters())
+        desks_marked = _pks(desks_marked if floor_pk is None else _on_floor(desks_marked, shown))
+        desks_by_floor = defaultdict(list)
         if not desks_marked:
-            return []
+            return desks_by_floor, desks_marked
 
-        desks = Desk.objects.filter(
-            pk__in={desk.pk for desk in list(desks_all) or Desk.objects.all()},
-        ).select_related(
-            "floor",
+        desks = _restrict(shown, desks_all).annotate(
+            connected=Exists(Occupancy.objects.filter(desk=OuterRef("pk"))),
         )
+        for pk, floor_id, connected in desks.values_list("pk", "floor_id", "connected"):
+            desks_by_floor[floor_id].append((pk, connected))
+        return desks_by_floor, desks_marked
 
-        shapes = []
-        for desk in desks:
-            if desk.floor != floor:
-                continue
-            if desk.x is None or desk.y is None:
-                continue
+    def _static_layers(self, floor_pks, refresh=False):
+        """
+        The markup of the desks and rooms of each floor, without the per request classes, split around the class
+        attribute. Cached, keyed on the version of the floor.
+        """
+        version_keys = {floor_pk: _floor_version_key(floor_pk) for floor_pk in floor_pks}
+        versions = cache.get_many(version_keys.values())
+        layer_keys = {
+            floor_pk: f"varsdaa:map:floor:{floor_pk}:{versions.get(key) or bump_floor_version(floor_pk)}:layer"
+            for floor_pk, key in version_keys.items()
+        }
+        cached = {} if refresh else cache.get_many(layer_keys.values())
+
+        layers = {floor_pk: cached[key] for floor_pk, key in layer_keys.items() if key in cached}
+        if missing := [floor_pk for floor_pk in floor_pks if floor_pk not in layers]:
+            rendered = self._render_static_layers(missing)
+            cache.set_many(
+                {layer_keys[floor_pk]: layer for floor_pk, layer in rendered.items()},
+                timeout=getattr(settings, "VARSDAA_MAP_CACHE_TIMEOUT", 24 * 60 * 60),
+            )
+            layers.update(rendered)
+        return layers
+
+    def _render_static_layers(self, floor_pks):
+        layers = {floor_pk: {"desks": {}, "rooms": {}} for floor_pk in floor_pks}
+        if self.renderer == "string":
+            render_desk_shapes, render_room_shapes = _render_desk_shapes, _render_room_shapes
+        else:
+            render_desk_shapes, render_room_shapes = self._render_desk_shapes, self._render_room_shapes
+
+        desks = Desk.objects.filter(floor_id__in=floor_pks, x__isnull=False, y__isnull=False)
+        for floor_id, pk, parts in render_desk_shapes(desks.values_list("floor_id", "pk", "x", "y")):
+            layers[floor_id]["desks"][pk] = parts
 
-            shapes.append(
-                html.a(
-                    html.circle(
-                        attrs={
-                            "class": {
-                                "desk": True,
-                                "marked": bool(desk in desks_marked),
-                                "connected": bool(any(desk.display_set.values_list('user', flat=True))),
+        rooms = Room.objects.filter(floor_id__in=floor_pks, x__isnull=False, y__isnull=False)
+        for floor_id, pk, parts in render_room_shapes(rooms.values_list("floor_id", "pk", "x", "y", "width", "height")):
+            layers[floor_id]["rooms"][pk] = parts
+
+        return layers
+
+    def _bind_and_render(self, shapes, class_name):
+        # Bound as children of one fragment: binding each shape on its own is several times slower
+        shapes = list(shapes)
+        container = Fragment(children={f"shape{i}": shape for i, (_, _, shape) in enumerate(shapes)})
+        container = container.bind(request=self.get_request())
+        for (floor_id, pk, _), shape in zip(shapes, values(container.children)):
+            yield floor_id, pk, _split_class(shape.__html__(), class_name)
+
+    def _render_room_shapes(self, rooms):
+        return self._bind_and_render(
+            (
+                (
+                    floor_id,
+                    pk,
+                    html.a(
+                        html.rect(
+                            attrs={
+                                "class": {"room": True},
+                                "data-room": pk,
+                                "x": x,
+                                "y": y,
+                                "width": width,
+                                "height": height,
                             },
-                            "data-desk": desk.pk,
-                            "r": 10,
-                            "cx": desk.x,
-                            "cy": desk.y,
-                        },
+                        ),
+                        attrs__href=Room(pk=pk).get_absolute_url(),
                     ),
-                    attrs__href=desk.get_absolute_url(),
-                ),
-            )
+                )
+                for floor_id, pk, x, y, width, height in rooms
+            ),
+            "room",
+        )
 
-        return shapes
+    def _render_desk_shapes(self, desks):
+        return self._bind_and_render(
+            (
+                (
+                    floor_id,
+                    pk,
+                    html.a(
+                        html.circle(
+                            attrs={
+                                "class": {"desk": True},
+                                "data-desk": pk,
+                                "r": 10,
+                                "cx": x,
+                                "cy": y,
+                            },
+                        ),
+                        attrs__href=Desk(pk=pk).get_absolute_url(),
+                    ),
+                )
+                for floor_id, pk, x, y in desks
+            ),
+            "desk",
+        )
@@ -0,0 +1,87 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:25
+
+import logging
+
+from django.db import migrations, models
+
+logger = logging.getLogger(__name__)
+
+
+def remove_duplicate_displays(apps, schema_editor):
+    # Keep one display per identity: the one connected to a desk, then the most recently reported, then the oldest.
+    # Nothing refers to displays yet, so the deleted rows are only the duplicates themselves, logged to be recreated.
+    Display = apps.get_model('varsdaa', 'Display')
+    kept = {}
+    duplicates = []
+    rows = Display.objects.order_by(
+        models.ExpressionWrapper(models.Q(desk__isnull=True), output_field=models.BooleanField()),
+        models.F('user_updated_at').desc(nulls_last=True),
+        'pk',
+    ).values_list('pk', 'product_name', 'alphanumeric_serial_number', 'serial_number', 'desk_id', 'user_id')
+    for pk, product_name, alphanumeric_serial_number, serial_number, desk_id, user_id in rows.iterator():
+        keys = [
+            (field, product_name, value)
+            for field, value in (
+                ('alphanumeric_serial_number', alphanumeric_serial_number),
+                ('serial_number', serial_number),
+            )
+            if value
+        ]
+        if original := next((kept[key] for key in keys if key in kept), None):
+            duplicates.append(pk)
+            logger.warning(
+                'Deleting display %s, a duplicate of display %s: product_name=%r, alphanumeric_serial_number=%r, '
+                'serial_number=%r, desk=%s, user=%s',
+                pk,
+                original,
+                product_name,
+                alphanumeric_serial_number,
+                serial_number,
+                desk_id,
+                user_id,
+            )
+        else:
+            kept.update(dict.fromkeys(keys, pk))
+    for start in range(0, len(duplicates), 1000):
+        Display.objects.filter(pk__in=duplicates[start : start + 1000]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0004_display_product_name_alter_display_user_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='display',
+            name='user_updated_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='display',
+            index=models.Index(
+                fields=['product_name', 'alphanumeric_serial_number'], name='display_alphanumeric_identity'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='display',
+            index=models.Index(fields=['product_name', 'serial_number'], name='display_serial_identity'),
+        ),
+        migrations.RunPython(remove_duplicate_displays, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='display',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('alphanumeric_serial_number', ''), _negated=True),
+                fields=('product_name', 'alphanumeric_serial_number'),
+                name='unique_display_alphanumeric_identity',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='display',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('serial_number', ''), _negated=True),
+                fields=('product_name', 'serial_number'),
+                name='unique_display_serial_identity',
+            ),
+        ),
+    ]
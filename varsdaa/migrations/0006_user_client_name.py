@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:31
+
+from django.db import migrations, models
+
+
+def backfill_client_name(apps, schema_editor):
+    # Names shared by several users stay unset, those users must be resolved by hand
+    User = apps.get_model('varsdaa', 'User')
+    unique_names = (
+        User.objects.exclude(name='').values('name').annotate(count=models.Count('pk')).filter(count=1).values('name')
+    )
+    User.objects.filter(name__in=unique_names).update(client_name=models.F('name'))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0005_display_identity_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='client_name',
+            field=models.CharField(
+                blank=True, max_length=255, null=True, unique=True, verbose_name='Name reported by client'
+            ),
+        ),
+        migrations.RunPython(backfill_client_name, migrations.RunPython.noop),
+    ]
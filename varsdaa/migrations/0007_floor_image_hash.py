@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:43
+
+import hashlib
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_image_hash(apps, schema_editor):
+    Floor = apps.get_model('varsdaa', 'Floor')
+    now = timezone.now()
+    for pk in Floor.objects.exclude(image=None).values_list('pk', flat=True):
+        image = Floor.objects.filter(pk=pk).values_list('image', flat=True).get()
+        Floor.objects.filter(pk=pk).update(image_hash=hashlib.sha256(image).hexdigest(), image_updated_at=now)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0006_user_client_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floor',
+            name='image_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='floor',
+            name='image_updated_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_image_hash, migrations.RunPython.noop),
+    ]
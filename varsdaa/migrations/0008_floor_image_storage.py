@@ -0,0 +1,49 @@
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+def move_images_to_storage(apps, schema_editor):
+    Floor = apps.get_model('varsdaa', 'Floor')
+    for pk in Floor.objects.exclude(image=None).values_list('pk', flat=True):
+        image = bytes(Floor.objects.filter(pk=pk).values_list('image', flat=True).get())
+        if not image:
+            continue
+        image_hash = hashlib.sha256(image).hexdigest()
+        name = f'floors/{image_hash}.png'
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(image))
+        Floor.objects.filter(pk=pk).update(image_file=name, image_hash=image_hash)
+
+
+def move_images_to_database(apps, schema_editor):
+    Floor = apps.get_model('varsdaa', 'Floor')
+    for pk, name in Floor.objects.exclude(image_file='').values_list('pk', 'image_file'):
+        with default_storage.open(name, 'rb') as file:
+            Floor.objects.filter(pk=pk).update(image=file.read())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0007_floor_image_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floor',
+            name='image_file',
+            field=models.FileField(blank=True, upload_to='floors/'),
+        ),
+        migrations.RunPython(move_images_to_storage, move_images_to_database),
+        migrations.RemoveField(
+            model_name='floor',
+            name='image',
+        ),
+        migrations.RenameField(
+            model_name='floor',
+            old_name='image_file',
+            new_name='image',
+        ),
+    ]
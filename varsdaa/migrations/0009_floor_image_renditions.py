@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:49
+
+from django.db import migrations, models
+
+
+def backfill_original_renditions(apps, schema_editor):
+    # Images were all stored as PNG until now
+    Floor = apps.get_model('varsdaa', 'Floor')
+    for pk, name in Floor.objects.exclude(image='').values_list('pk', 'image'):
+        Floor.objects.filter(pk=pk).update(image_renditions={'original': {'image/png': name}})
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0008_floor_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floor',
+            name='image_renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(backfill_original_renditions, migrations.RunPython.noop),
+    ]
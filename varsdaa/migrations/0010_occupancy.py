@@ -0,0 +1,54 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_occupancy(apps, schema_editor):
+    Desk = apps.get_model('varsdaa', 'Desk')
+    Display = apps.get_model('varsdaa', 'Display')
+    User = apps.get_model('varsdaa', 'User')
+    latest = Display.objects.order_by(models.F('user_updated_at').desc(nulls_last=True), '-pk')
+    User.objects.update(
+        current_desk=models.Subquery(
+            latest.filter(user=models.OuterRef('pk'), desk__isnull=False).values('desk_id')[:1]
+        )
+    )
+    Desk.objects.update(
+        current_occupant=models.Subquery(
+            latest.filter(desk=models.OuterRef('pk'), user__isnull=False).values('user_id')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0009_floor_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='desk',
+            name='current_occupant',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+',
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='current_desk',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+',
+                to='varsdaa.desk',
+            ),
+        ),
+        migrations.RunPython(fill_occupancy, migrations.RunPython.noop),
+    ]
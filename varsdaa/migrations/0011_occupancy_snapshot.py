@@ -0,0 +1,61 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_occupancy(apps, schema_editor):
+    Desk = apps.get_model('varsdaa', 'Desk')
+    Display = apps.get_model('varsdaa', 'Display')
+    Occupancy = apps.get_model('varsdaa', 'Occupancy')
+    latest = Display.objects.order_by(models.F('user_updated_at').desc(nulls_last=True), '-pk')
+    rows = (
+        Desk.objects.filter(current_occupant__isnull=False)
+        .annotate(
+            last_seen=models.Subquery(
+                latest.filter(desk=models.OuterRef('pk'), user__isnull=False).values('user_updated_at')[:1]
+            )
+        )
+        .values_list('pk', 'floor_id', 'floor__office_id', 'current_occupant_id', 'last_seen')
+    )
+    Occupancy.objects.bulk_create(
+        [
+            Occupancy(desk_id=pk, floor_id=floor_id, office_id=office_id, user_id=user_id, last_seen=last_seen)
+            for pk, floor_id, office_id, user_id, last_seen in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0010_occupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Occupancy',
+            fields=[
+                (
+                    'desk',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name='occupancy',
+                        serialize=False,
+                        to='varsdaa.desk',
+                    ),
+                ),
+                ('last_seen', models.DateTimeField(null=True)),
+                ('floor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='varsdaa.floor')),
+                ('office', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='varsdaa.office')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'occupancy',
+                'verbose_name_plural': 'occupancies',
+            },
+        ),
+        migrations.RunPython(fill_occupancy, migrations.RunPython.noop),
+    ]
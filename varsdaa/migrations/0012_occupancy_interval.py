@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0011_occupancy_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancyInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('desk', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='varsdaa.desk')),
+                ('display', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='varsdaa.display')),
+                (
+                    'floor',
+                    models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='varsdaa.floor'),
+                ),
+                (
+                    'office',
+                    models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='varsdaa.office'),
+                ),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'occupancy interval',
+                'verbose_name_plural': 'occupancy intervals',
+                'indexes': [
+                    models.Index(fields=['display', 'ended_at'], name='interval_display_ended'),
+                    models.Index(fields=['desk', 'started_at'], name='interval_desk_started'),
+                    models.Index(fields=['floor', 'started_at'], name='interval_floor_started'),
+                    models.Index(fields=['office', 'started_at'], name='interval_office_started'),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0012_occupancy_interval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'scope',
+                    models.CharField(
+                        choices=[('desk', 'desk'), ('floor', 'floor'), ('office', 'office')], max_length=8
+                    ),
+                ),
+                ('resolution', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=8)),
+                ('object_id', models.IntegerField()),
+                ('period', models.DateField()),
+                ('values', models.JSONField(default=list)),
+            ],
+            options={
+                'verbose_name': 'occupancy rollup',
+                'verbose_name_plural': 'occupancy rollups',
+                'indexes': [models.Index(fields=['scope', 'resolution', 'period'], name='occupancy_rollup_period')],
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('scope', 'resolution', 'object_id', 'period'), name='unique_occupancy_rollup'
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('varsdaa', '0013_occupancy_rollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='occupancyinterval',
+            index=models.Index(fields=['started_at'], name='interval_started'),
+        ),
+    ]
@@ -1,9 +1,27 @@
+import hashlib
 from typing import ClassVar
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.core.files.base import ContentFile
 from django.db import models
-from django.db.models import BinaryField, CharField, DateTimeField, EmailField, ForeignKey, IntegerField, Model
+from django.db.models import (
+    CharField,
+    DateField,
+    DateTimeField,
+    EmailField,
+    FileField,
+    ForeignKey,
+    Index,
+    IntegerField,
+    JSONField,
+    Model,
+    OneToOneField,
+    Q,
+    UniqueConstraint,
+)
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from varsdaa.managers import UserManager
@@ -11,6 +29,7 @@ from varsdaa.managers import UserManager
 
 class User(AbstractUser):
     name = CharField(_("Name of User"), blank=True, max_length=255)
+    client_name = CharField(_("Name reported by client"), unique=True, null=True, blank=True, max_length=255)
     first_name = None  # type: ignore[assignment]
     last_name = None  # type: ignore[assignment]
     email = EmailField(_("email address"), unique=True)
@@ -26,6 +45,8 @@ class User(AbstractUser):
 
     office = ForeignKey(to='Office', on_delete=models.CASCADE, null=True)
     office_updated_at = DateTimeField(auto_now=True)
+    # Maintained by varsdaa.occupancy: the desk of the display this user most recently reported
+    current_desk = ForeignKey(to='Desk', on_delete=models.SET_NULL, null=True, editable=False, related_name='+')
 
 
 class Office(Model):
@@ -38,6 +59,34 @@ class Office(Model):
         return f"<Office pk={self.pk}, display_name={self.display_name!r}>"
 
 
+IMAGE_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+
+def image_extension(image):
+    if image.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if image.startswith(b"GIF8"):
+        return "gif"
+    if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+        return "webp"
+    if image[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    # PNG, and anything else as before
+    return "png"
+
+
+def floor_image_name(image_hash, extension="png", size=None):
+    if size:
+        return f"floors/{image_hash}/{size}.{extension}"
+    return f"floors/{image_hash}.{extension}"
+
+
 class Floor(Model):
     display_name = CharField(max_length=255)
     office = ForeignKey(
@@ -45,7 +94,11 @@ class Floor(Model):
         null=False,
         on_delete=models.CASCADE,
     )
-    image = BinaryField(editable=True, null=True)
+    image = FileField(upload_to="floors/", blank=True)
+    image_hash = CharField(max_length=64, blank=True, default="", editable=False)
+    image_updated_at = DateTimeField(null=True, editable=False)
+    # The stored files of the image by size ("original", "thumbnail", "map") and content type, in order of preference
+    image_renditions = JSONField(default=dict, blank=True, editable=False)
 
     class Meta:
         verbose_name = _("floor")
@@ -60,6 +113,37 @@ class Floor(Model):
     def get_absolute_url(self):
         return f"/floor/{self.pk}/"
 
+    def get_image_url(self, size=None):
+        if not self.image_hash:
+            return f"/floor/{self.pk}/image/"
+        if getattr(settings, "VARSDAA_SERVE_FLOOR_IMAGES_FROM_STORAGE", False):
+            # No content negotiation here, so the last rendition, the most widely supported format
+            renditions = self.image_renditions.get(size) or self.image_renditions["original"]
+            return self._meta.get_field("image").storage.url(list(renditions.values())[-1])
+        if size:
+            return f"/floor/{self.pk}/image/{self.image_hash}/?size={size}"
+        return f"/floor/{self.pk}/image/{self.image_hash}/"
+
+    def get_thumbnail_url(self):
+        return self.get_image_url("thumbnail")
+
+    def set_image(self, image):
+        self.image_hash = hashlib.sha256(image).hexdigest() if image else ""
+        self.image_updated_at = timezone.now()
+        if not image:
+            self.image = ""
+            self.image_renditions = {}
+            return
+
+        # Named by content, so the file of an image never changes and can be cached forever
+        extension = image_extension(image)
+        name = floor_image_name(self.image_hash, extension)
+        storage = self._meta.get_field("image").storage
+        if not storage.exists(name):
+            storage.save(name, ContentFile(image))
+        self.image = name
+        self.image_renditions = {"original": {IMAGE_TYPES[extension]: name}}
+
 
 class Room(Model):
     display_name = CharField(max_length=255)
@@ -98,6 +182,8 @@ class Desk(Model):
     )
     x = IntegerField(null=True)
     y = IntegerField(null=True)
+    # Maintained by varsdaa.occupancy: the user who most recently reported a display on this desk
+    current_occupant = ForeignKey(to=User, on_delete=models.SET_NULL, null=True, editable=False, related_name='+')
 
     class Meta:
         verbose_name = _("desk")
@@ -119,7 +205,109 @@ class Display(Model):
     serial_number = CharField(max_length=255)
     alphanumeric_serial_number = CharField(max_length=255)
     user = ForeignKey(to=User, on_delete=models.CASCADE, null=True)
-    user_updated_at = DateTimeField(null=True)
+    user_updated_at = DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            Index(fields=["product_name", "alphanumeric_serial_number"], name="display_alphanumeric_identity"),
+            Index(fields=["product_name", "serial_number"], name="display_serial_identity"),
+        ]
+        constraints = [
+            UniqueConstraint(
+                fields=["product_name", "alphanumeric_serial_number"],
+                condition=~Q(alphanumeric_serial_number=""),
+                name="unique_display_alphanumeric_identity",
+            ),
+            UniqueConstraint(
+                fields=["product_name", "serial_number"],
+                condition=~Q(serial_number=""),
+                name="unique_display_serial_identity",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.product_name}: {self.serial_number}"
+
+
+class Occupancy(Model):
+    """
+    Who sits where: one row per occupied desk, with the floor and office of the desk copied in so the pages listing
+    people can find them without joining through displays and desks. Maintained by `varsdaa.occupancy`.
+    """
+
+    desk = OneToOneField(to=Desk, on_delete=models.CASCADE, primary_key=True, related_name="occupancy")
+    floor = ForeignKey(to=Floor, on_delete=models.CASCADE)
+    office = ForeignKey(to=Office, on_delete=models.CASCADE)
+    user = ForeignKey(to=User, on_delete=models.CASCADE)
+    last_seen = DateTimeField(null=True)
+
+    class Meta:
+        verbose_name = _("occupancy")
+        verbose_name_plural = _("occupancies")
+
+    def __repr__(self):
+        return f"<Occupancy desk_id={self.desk_id}, user_id={self.user_id}, last_seen={self.last_seen}>"
+
+
+class OccupancyInterval(Model):
+    """
+    The history of who used which display: a user reported a display, on the desk it was on then, continuously from
+    `started_at` to `ended_at`. Written by `varsdaa.history`, which extends the open interval of a display on every
+    report instead of adding a row.
+    """
+
+    display = ForeignKey(to=Display, on_delete=models.CASCADE)
+    user = ForeignKey(to=User, on_delete=models.CASCADE)
+    desk = ForeignKey(to=Desk, on_delete=models.SET_NULL, null=True)
+    floor = ForeignKey(to=Floor, on_delete=models.SET_NULL, null=True)
+    office = ForeignKey(to=Office, on_delete=models.SET_NULL, null=True)
+    started_at = DateTimeField()
+    ended_at = DateTimeField()
+
+    class Meta:
+        verbose_name = _("occupancy interval")
+        verbose_name_plural = _("occupancy intervals")
+        indexes = [
+            Index(fields=["display", "ended_at"], name="interval_display_ended"),
+            Index(fields=["started_at"], name="interval_started"),
+            Index(fields=["desk", "started_at"], name="interval_desk_started"),
+            Index(fields=["floor", "started_at"], name="interval_floor_started"),
+            Index(fields=["office", "started_at"], name="interval_office_started"),
+        ]
+
+    def __repr__(self):
+        return (
+            f"<OccupancyInterval display_id={self.display_id}, user_id={self.user_id}, desk_id={self.desk_id}, "
+            f"started_at={self.started_at}, ended_at={self.ended_at}>"
+        )
+
+
+class OccupancyRollup(Model):
+    """
+    Occupancy aggregated per desk, floor or office, as an array of numbers per period. Hourly rollups have a row per
+    day with 24 values, daily rollups a row per year with a value per day of the year. Desks count occupied minutes,
+    floors and offices count occupied desks: per hour, and the peak hour of each day. Written by `varsdaa.rollups`.
+    """
+
+    scope = CharField(max_length=8, choices=[("desk", "desk"), ("floor", "floor"), ("office", "office")])
+    resolution = CharField(max_length=8, choices=[("hour", "hour"), ("day", "day")])
+    object_id = IntegerField()
+    # The day of an hourly rollup, January 1st for a daily one
+    period = DateField()
+    values = JSONField(default=list)
+
+    class Meta:
+        verbose_name = _("occupancy rollup")
+        verbose_name_plural = _("occupancy rollups")
+        constraints = [
+            UniqueConstraint(fields=["scope", "resolution", "object_id", "period"], name="unique_occupancy_rollup"),
+        ]
+        indexes = [
+            Index(fields=["scope", "resolution", "period"], name="occupancy_rollup_period"),
+        ]
+
+    def __repr__(self):
+        return (
+            f"<OccupancyRollup scope={self.scope!r}, resolution={self.resolution!r}, object_id={self.object_id}, "
+            f"period={self.period}>"
+        )
@@ -0,0 +1,136 @@
+from django.db.models import Case, DateTimeField, F, OuterRef, Q, Subquery, Value, When
+
+from varsdaa.models import Desk, Display, Occupancy, User
+
+SNAPSHOT_FIELDS = ["floor", "office", "user", "last_seen"]
+
+
+def _latest_display():
+    return Display.objects.order_by(F("user_updated_at").desc(nulls_last=True), "-pk")
+
+
+def latest_desk():
+    """
+    The desk of the display the user of the outer query most recently reported, as a subquery.
+    """
+    return Subquery(_latest_display().filter(user=OuterRef("pk"), desk__isnull=False).values("desk_id")[:1])
+
+
+def _latest_on_desk():
+    return _latest_display().filter(desk=OuterRef("pk"), user__isnull=False)
+
+
+def latest_occupant():
+    """
+    The user who most recently reported a display on the desk of the outer query, as a subquery.
+    """
+    return Subquery(_latest_on_desk().values("user_id")[:1])
+
+
+def latest_seen():
+    """
+    When the display of `latest_occupant` was last reported, as a subquery.
+    """
+    return Subquery(_latest_on_desk().values("user_updated_at")[:1])
+
+
+def _write_snapshot(rows):
+    """
+    Upsert the `Occupancy` of the occupied desks of `rows` and delete it for the rest. `rows` are tuples of
+    `(desk_id, floor_id, office_id, user_id, last_seen)`, with a `user_id` of `None` for vacant desks.
+    """
+    Occupancy.objects.bulk_create(
+        [
+            Occupancy(desk_id=pk, floor_id=floor_id, office_id=office_id, user_id=user_id, last_seen=last_seen)
+            for pk, floor_id, office_id, user_id, last_seen in rows
+            if user_id is not None
+        ],
+        update_conflicts=True,
+        unique_fields=["desk"],
+        update_fields=SNAPSHOT_FIELDS,
+    )
+    if vacant := [pk for pk, _, _, user_id, _ in rows if user_id is None]:
+        Occupancy.objects.filter(desk__in=vacant).delete()
+
+
+def occupy(desk, user, last_seen):
+    """
+    Record that `user` sits at `desk` since their display there was reported at `last_seen`, without looking at the
+    displays.
+    """
+    Desk.objects.filter(pk=desk.pk).update(current_occupant=user)
+    _write_snapshot([(desk.pk, desk.floor_id, desk.floor.office_id, user.pk, last_seen)])
+
+
+def touch_occupancy(seen):
+    """
+    Move `Occupancy.last_seen` forward after users reported displays they were already connected to. `seen` is a dict
+    from `(desk_id, user_id)` to when the user was seen at the desk. Takes one query. Returns the keys of `seen` if any
+    of the desks had another occupant, the report makes the user the occupant again, so those need
+    `refresh_occupancy`.
+    """
+    if not seen:
+        return set()
+    occupied = Q()
+    for desk_id, user_id in seen:
+        occupied |= Q(desk=desk_id, user=user_id)
+    touched = Occupancy.objects.filter(occupied).update(
+        last_seen=Case(
+            *(When(desk=desk_id, then=Value(last_seen)) for (desk_id, _), last_seen in seen.items()),
+            output_field=DateTimeField(),
+        )
+    )
+    return set() if touched == len(seen) else set(seen)
+
+
+def refresh_occupancy(user_pks=(), desk_pks=()):
+    """
+    Update `User.current_desk` of `user_pks`, and `Desk.current_occupant` and the `Occupancy` of `desk_pks` from
+    their displays, after the displays were connected, disconnected or reported. Takes one query for each model to
+    read, and one for each to write what changed.
+    """
+    if user_pks := {pk for pk in user_pks if pk is not None}:
+        rows = (
+            User.objects.filter(pk__in=user_pks)
+            .annotate(latest=latest_desk())
+            .values_list("pk", "current_desk_id", "latest")
+        )
+        User.objects.bulk_update(
+            [User(pk=pk, current_desk_id=latest) for pk, current, latest in rows if current != latest],
+            ["current_desk"],
+        )
+
+    if desk_pks := {pk for pk in desk_pks if pk is not None}:
+        rows = (
+            Desk.objects.filter(pk__in=desk_pks)
+            .annotate(latest=latest_occupant(), last_seen=latest_seen())
+            .values_list("pk", "current_occupant_id", "latest", "floor_id", "floor__office_id", "last_seen")
+        )
+        Desk.objects.bulk_update(
+            [Desk(pk=pk, current_occupant_id=latest) for pk, current, latest, *_ in rows if current != latest],
+            ["current_occupant"],
+        )
+        _write_snapshot(
+            [(pk, floor_id, office_id, latest, last_seen) for pk, _, latest, floor_id, office_id, last_seen in rows]
+        )
+
+
+def rebuild_occupancy():
+    """
+    Recompute `User.current_desk`, `Desk.current_occupant` and the `Occupancy` snapshot of everyone and every desk.
+    """
+    User.objects.update(current_desk=latest_desk())
+    Desk.objects.update(current_occupant=latest_occupant())
+    Occupancy.objects.all().delete()
+    rows = (
+        Desk.objects.filter(current_occupant__isnull=False)
+        .annotate(last_seen=latest_seen())
+        .values_list("pk", "floor_id", "floor__office_id", "current_occupant_id", "last_seen")
+    )
+    Occupancy.objects.bulk_create(
+        [
+            Occupancy(desk_id=pk, floor_id=floor_id, office_id=office_id, user_id=user_id, last_seen=last_seen)
+            for pk, floor_id, office_id, user_id, last_seen in rows.iterator()
+        ],
+        batch_size=1000,
+    )
@@ -1,86 +1,129 @@
 import json
 
-from django.http import HttpResponseRedirect, JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.template import Template
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.http import urlencode
 from django.views.decorators.csrf import csrf_exempt
-from iommi import Asset, get_current_request
+from iommi import Asset
 from iommi.form import choice_queryset__parse
 from iommi.struct import Struct
 
 from varsdaa.autosubmit_form import AutosubmitForm
+from varsdaa.ingest import (
+    aapply_report,
+    apply_report,
+    apply_reports,
+    aresolve_displays,
+    aresolve_user,
+    client_identity,
+    display_identity,
+    normalize_display_report,
+    resolve_displays,
+    resolve_user,
+    resolve_users,
+)
 from varsdaa.iommi import Field, Form, Page
 from varsdaa.map import Map
 from varsdaa.models import Desk, Display, Floor, Office, User
+from varsdaa.occupancy import occupy
+from varsdaa.write_behind import write_behind_queue
 
 
 @csrf_exempt
 def report_display(request):
     report = json.loads(request.body)
 
-    full_name = report.get("full_name")
-    user = get_object_or_404(User, name=full_name)  # @todo Take the login-with-google detour first somehow if no user
+    user = resolve_user(client_identity(report))
+    if user is None:
+        raise Http404  # @todo Take the login-with-google detour first somehow if no user
 
     response = {}
 
-    display_identified = False
-    for display_report in report["displays"]:
-        serial_number = display_report.get("serial_number", None)
-        alphanumeric_serial_number = display_report.get("alphanumeric_serial_number", None)
-
-        # Hack to be compatible with Windows clients reporting alphanumeric_serial_number as serial_number
-        if not alphanumeric_serial_number and serial_number and not serial_number.isdigit():
-            display_report["alphanumeric_serial_number"] = serial_number
-            alphanumeric_serial_number = serial_number
-            del display_report["serial_number"]
-
-        product_name = display_report["product_name"]
-
-        try:
-            try:
-                display = Display.objects.get(
-                    alphanumeric_serial_number=alphanumeric_serial_number,
-                    product_name=product_name,
-                )
-            except Display.DoesNotExist:
-                display = Display.objects.get(
-                    serial_number=serial_number,
-                    product_name=product_name,
-                )
-
-            timestamp = timezone.now()
-            display.user = user
-            display.user_updated_at = timestamp
-            display.save()
-
-            if display.desk:
-                user.office = display.desk.floor.office
-                user.office_updated_at = timestamp
-                user.save()
-
-            display_identified = True
-
-        except Display.DoesNotExist:
-            response["url"] = register_display_url(display_report, user)
-        except Display.MultipleObjectsReturned:
-            pass
-
-    if not display_identified:
-        try:
-            display = Display.objects.get(user=user)
-            display.user = None
-            display.save()
-        except (Desk.DoesNotExist, Display.DoesNotExist):
-            pass
+    display_reports = [normalize_display_report(display_report) for display_report in report["displays"]]
+    identified, unknown = resolve_displays(display_reports)
+    if getattr(settings, "VARSDAA_REPORT_WRITE_BEHIND", False):
+        write_behind_queue.enqueue(user, identified, timezone.now())
+    else:
+        apply_report(user, identified)
+
+    for display_report in unknown:
+        response["url"] = register_display_url(request, display_report, user)
 
     return JsonResponse(data=response)
 
 
-def register_display_url(display_report, user):
-    request = get_current_request()
+@csrf_exempt
+async def areport_display(request):
+    report = json.loads(request.body)
+
+    user = await aresolve_user(client_identity(report))
+    if user is None:
+        raise Http404
+
+    response = {}
+
+    display_reports = [normalize_display_report(display_report) for display_report in report["displays"]]
+    identified, unknown = await aresolve_displays(display_reports)
+    if getattr(settings, "VARSDAA_REPORT_WRITE_BEHIND", False):
+        write_behind_queue.enqueue(user, identified, timezone.now())
+    else:
+        await aapply_report(user, identified)
+
+    for display_report in unknown:
+        response["url"] = register_display_url(request, display_report, user)
+
+    return JsonResponse(data=response)
+
+
+@csrf_exempt
+def report_displays(request):
+    reports = json.loads(request.body)
+    timestamp = timezone.now()
+
+    users = resolve_users({client_identity(report) for report in reports})
+
+    display_reports_by_report = [
+        [normalize_display_report(display_report) for display_report in report["displays"]] for report in reports
+    ]
+    identified, _ = resolve_displays(
+        [display_report for display_reports in display_reports_by_report for display_report in display_reports]
+    )
+
+    results = []
+    user_reports = []
+    for report, display_reports in zip(reports, display_reports_by_report, strict=True):
+        result = dict(full_name=report.get("full_name"))
+        results.append(result)
+
+        user = users.get(client_identity(report))
+        if user is None:
+            result["error"] = "Unknown user"
+            continue
+
+        user_identified = {}
+        for display_report in display_reports:
+            identity = display_identity(display_report)
+            if identity in identified:
+                user_identified[identity] = identified[identity]
+            else:
+                result["url"] = register_display_url(request, display_report, user)
+        user_reports.append((user, user_identified, timestamp))
+
+    if getattr(settings, "VARSDAA_REPORT_WRITE_BEHIND", False):
+        for user_report in user_reports:
+            write_behind_queue.enqueue(*user_report)
+    else:
+        apply_reports(user_reports)
+
+    return JsonResponse(data=results, safe=False)
+
+
+def register_display_url(request, display_report, user):
     params = dict(
         **display_report,
     )
@@ -124,18 +167,15 @@ def register_display(request, email):
             Template(
                 # language=javascript
                 """
-                    window.addEventListener('DOMContentLoaded', function (event) {
-                        document.querySelectorAll('.desk').forEach(
-                            desk => setupSelect(desk)
-                        );
-                    });
-                    function setupSelect(desk) {
-                        desk.addEventListener('click', (event) => {
+                    // Delegated, desks drawn by the client renderer don't exist yet when the page loads
+                    document.addEventListener('click', (event) => {
+                        var desk = event.target.closest('.desk');
+                        if (desk) {
                             event.preventDefault();
                             var pk = desk.getAttribute('data-desk');
                             $('#id_desk').val(pk).trigger('change');
-                        });
-                    }
+                        }
+                    });
                 """
             )
         ),
@@ -151,7 +191,11 @@ def register_display(request, email):
         display.desk = desk
         display.user_updated_at = timezone.now()
         user.office = office
-        user.save()
+        # The registered display is now the latest one of both the user and the desk
+        user.current_desk = desk
+        with transaction.atomic():
+            user.save()
+            occupy(desk, user, display.user_updated_at)
 
     register_display_form = Form.create(
         actions__submit__include=bool(office) & bool(floor) & bool(desk),
@@ -0,0 +1,147 @@
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from varsdaa.history import intervals_at_desks, merge_spans
+from varsdaa.models import OccupancyInterval, OccupancyRollup
+
+SCOPES = ("desk", "floor", "office")
+RESOLUTIONS = ("hour", "day")
+
+
+def _hour_start(day, hour):
+    return timezone.make_aware(datetime.combine(day, time()) + timedelta(hours=hour))
+
+
+def _days(start, end):
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def _year_index(day):
+    return day.timetuple().tm_yday - 1
+
+
+def _hourly_desk_minutes(spans, start, end):
+    """
+    The occupied minutes of each hour from the day `start` to the day `end` covered by the merged `spans` of a desk, as
+    a dict from day to a list of 24 numbers. Days without occupancy are left out.
+    """
+    minutes = {}
+    for span_start, span_end in spans:
+        for day in _days(max(timezone.localdate(span_start), start), min(timezone.localdate(span_end), end)):
+            for hour in range(24):
+                overlap = min(span_end, _hour_start(day, hour + 1)) - max(span_start, _hour_start(day, hour))
+                if overlap > timedelta(0):
+                    hours = minutes.setdefault(day, [0] * 24)
+                    hours[hour] = min(hours[hour] + round(overlap.total_seconds() / 60), 60)
+    return minutes
+
+
+def update_rollups(start, end=None):
+    """
+    Recompute the rollups of the days from `start` to `end`, by default today, from the occupancy history. Only the
+    days that can have changed need to be recomputed: the history is append-only, so running this regularly from the
+    day of the last run keeps the rollups up to date.
+    """
+    end = end or timezone.localdate()
+    intervals = intervals_at_desks(_hour_start(start, 0), _hour_start(end, 24)).values_list(
+        "desk_id", "floor_id", "office_id", "started_at", "ended_at"
+    )
+
+    spans = defaultdict(list)
+    groups = {}
+    for desk_id, floor_id, office_id, started_at, ended_at in intervals:
+        spans[desk_id].append((started_at, ended_at))
+        groups[desk_id] = {"floor": floor_id, "office": office_id}
+
+    hourly = {}
+    for desk_id, desk_spans in spans.items():
+        for day, minutes in _hourly_desk_minutes(merge_spans(desk_spans), start, end).items():
+            hourly["desk", desk_id, day] = minutes
+            for scope, pk in groups[desk_id].items():
+                if pk is not None:
+                    counts = hourly.setdefault((scope, pk, day), [0] * 24)
+                    for hour, occupied in enumerate(minutes):
+                        counts[hour] += bool(occupied)
+
+    # Desks sum their occupied minutes over the day, floors and offices keep their peak hour
+    daily = {key: sum(values) if key[0] == "desk" else max(values) for key, values in hourly.items()}
+    years = {(scope, pk, date(day.year, 1, 1)) for scope, pk, day in daily}
+    existing = OccupancyRollup.objects.filter(
+        resolution="day",
+        period__in={period for _, _, period in years},
+        object_id__in={pk for _, pk, _ in years},
+    ).values_list("scope", "object_id", "period", "values")
+    yearly = {(scope, pk, period): values for scope, pk, period, values in existing if (scope, pk, period) in years}
+    for (scope, pk, day), value in daily.items():
+        values = yearly.setdefault((scope, pk, date(day.year, 1, 1)), [0] * 366)
+        values[_year_index(day)] = value
+
+    OccupancyRollup.objects.bulk_create(
+        [
+            OccupancyRollup(scope=scope, resolution="hour", object_id=pk, period=day, values=values)
+            for (scope, pk, day), values in hourly.items()
+        ]
+        + [
+            OccupancyRollup(scope=scope, resolution="day", object_id=pk, period=period, values=values)
+            for (scope, pk, period), values in yearly.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["scope", "resolution", "object_id", "period"],
+        update_fields=["values"],
+        batch_size=500,
+    )
+
+
+def pending_rollup_start():
+    """
+    The first day `update_rollups` needs to recompute: the last day rolled up, or the first day of the history if
+    nothing is rolled up yet. `None` if there is no history.
+    """
+    last = OccupancyRollup.objects.filter(resolution="hour").aggregate(last=Max("period"))["last"]
+    if last is not None:
+        return last
+    first = OccupancyInterval.objects.aggregate(first=Min("started_at"))["first"]
+    return timezone.localdate(first) if first else None
+
+
+def rollup_values(scope, resolution, start, end, pks=None):
+    """
+    The rollups of the desks, floors or offices `pks`, or all of them, from the day `start` to the day `end`, as a dict
+    from primary key to one flat list: 24 values per day for hourly rollups, one per day for daily ones. Periods
+    without a rollup are zeros.
+    """
+    assert scope in SCOPES, scope
+    assert resolution in RESOLUTIONS, resolution
+    rollups = OccupancyRollup.objects.filter(scope=scope, resolution=resolution)
+    if resolution == "hour":
+        rollups = rollups.filter(period__range=(start, end))
+    else:
+        rollups = rollups.filter(period__range=(date(start.year, 1, 1), date(end.year, 1, 1)))
+    if pks is not None:
+        rollups = rollups.filter(object_id__in=pks)
+
+    width = 24 if resolution == "hour" else 1
+    result = {}
+    for pk, period, values in rollups.values_list("object_id", "period", "values"):
+        flat = result.setdefault(pk, [0] * (((end - start).days + 1) * width))
+        if resolution == "hour":
+            offset = (period - start).days * 24
+            flat[offset : offset + 24] = values
+        else:
+            first, last = max(start, period), min(end, date(period.year, 12, 31))
+            offset = (first - start).days
+            flat[offset : offset + (last - first).days + 1] = values[_year_index(first) : _year_index(last) + 1]
+    return result
+
+
+def desk_heat(start, end, pks=None):
+    """
+    How much each desk was used from the day `start` to the day `end` relative to the most used desk, between `0` and
+    `1`, from the daily rollups. Desks that weren't used are left out.
+    """
+    minutes = {pk: sum(values) for pk, values in rollup_values("desk", "day", start, end, pks).items()}
+    busiest = max(minutes.values(), default=0)
+    return {pk: value / busiest for pk, value in minutes.items() if value}
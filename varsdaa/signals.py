@@ -0,0 +1,52 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from varsdaa.ingest import display_identity_cache, user_identity_cache
+from varsdaa.map import bump_floor_version
+from varsdaa.models import Desk, Display, Floor, Room, User
+from varsdaa.occupancy import refresh_occupancy
+
+
+@receiver(post_save, sender=Display)
+@receiver(post_delete, sender=Display)
+@receiver(post_save, sender=Desk)
+@receiver(post_delete, sender=Desk)
+@receiver(post_save, sender=Floor)
+@receiver(post_delete, sender=Floor)
+def clear_display_identity_cache(**_):
+    display_identity_cache.clear()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def clear_user_identity_cache(**_):
+    user_identity_cache.clear()
+
+
+@receiver(post_save, sender=Desk)
+@receiver(post_delete, sender=Desk)
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def bump_floor_version_of_shape(instance, **_):
+    bump_floor_version(instance.floor_id)
+
+
+@receiver(post_save, sender=Floor)
+@receiver(post_delete, sender=Floor)
+def bump_floor_version_of_floor(instance, **_):
+    bump_floor_version(instance.pk)
+
+
+@receiver(pre_save, sender=Display)
+def remember_display_occupant(instance, **_):
+    instance._saved_occupant = (
+        Display.objects.filter(pk=instance.pk).values_list("user_id", "desk_id").first() if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Display)
+@receiver(post_delete, sender=Display)
+def refresh_occupancy_of_display(instance, **_):
+    # Displays edited or deleted in the admin, reports write with update() and refresh themselves
+    user_id, desk_id = getattr(instance, "_saved_occupant", None) or (None, None)
+    refresh_occupancy(user_pks=[user_id, instance.user_id], desk_pks=[desk_id, instance.desk_id])
@@ -198,6 +198,97 @@
         });
     }
 
+    const SVG_NS = 'http://www.w3.org/2000/svg';
+
+    // The geometry of each floor by URL, kept across the reloads of filter changes
+    const geometries = {};
+
+    function fetchJSON(url) {
+        return fetch(url, {credentials: 'same-origin'}).then(response => {
+            if (!response.ok) {
+                throw new Error(`${url}: ${response.status}`);
+            }
+            return response.json();
+        });
+    }
+
+    function fetchGeometry(url) {
+        if (!(url in geometries)) {
+            geometries[url] = fetchJSON(url).catch(error => {
+                delete geometries[url];
+                throw error;
+            });
+        }
+        return geometries[url];
+    }
+
+    function createShape(tag, href, attrs, classes) {
+        const link = document.createElementNS(SVG_NS, 'a');
+        link.setAttribute('href', href);
+        const shape = document.createElementNS(SVG_NS, tag);
+        for (const [name, value] of Object.entries(attrs)) {
+            if (value !== null) {
+                shape.setAttribute(name, value);
+            }
+        }
+        shape.classList.add(...classes);
+        link.appendChild(shape);
+        return link;
+    }
+
+    // Draw the shapes of a map rendered by the "client" renderer: the geometry of the floor is fetched once, only the
+    // state (which shapes to show and how) is fetched for every filter change
+    async function renderMap(mapSVG, refetched) {
+        const url = mapSVG.dataset.mapGeometry;
+        const [geometry, state] = await Promise.all([fetchGeometry(url), fetchJSON(mapSVG.dataset.mapState)]);
+        const desks = new Map(geometry.desks.map(desk => [desk[0], desk]));
+        const rooms = new Map(geometry.rooms.map(room => [room[0], room]));
+
+        if (!refetched && (state.desks.some(pk => !desks.has(pk)) || state.rooms.some(pk => !rooms.has(pk)))) {
+            // Shapes added since the geometry was fetched
+            delete geometries[url];
+            return renderMap(mapSVG, true);
+        }
+
+        const markedDesks = new Set(state.marked_desks);
+        const connectedDesks = new Set(state.connected_desks);
+        const markedRooms = new Set(state.marked_rooms);
+        const shapes = document.createDocumentFragment();
+
+        state.desks.filter(pk => desks.has(pk)).forEach(pk => {
+            const [, x, y] = desks.get(pk);
+            const classes = ['desk'];
+            if (markedDesks.has(pk)) {
+                classes.push('marked');
+            }
+            if (connectedDesks.has(pk)) {
+                classes.push('connected');
+            }
+            if (pk in state.heat) {
+                classes.push(`heat-${state.heat[pk]}`);
+            }
+            shapes.appendChild(createShape('circle', `/desk/${pk}/`, {'data-desk': pk, r: 10, cx: x, cy: y}, classes));
+        });
+
+        state.rooms.filter(pk => rooms.has(pk)).forEach(pk => {
+            const [, x, y, width, height] = rooms.get(pk);
+            const classes = markedRooms.has(pk) ? ['room', 'marked'] : ['room'];
+            shapes.appendChild(createShape('rect', `/room/${pk}/`, {'data-room': pk, x, y, width, height}, classes));
+        });
+
+        mapSVG.appendChild(shapes);
+        setupHoverDispatcher(mapSVG);
+    }
+
+    function setupClientMaps() {
+        document.querySelectorAll('.map-svg[data-map-geometry]').forEach(mapSVG => {
+            if (!mapSVG.dataset.mapRendered) {
+                mapSVG.dataset.mapRendered = 'true';
+                renderMap(mapSVG).catch(error => console.error(error));
+            }
+        });
+    }
+
     function setupTableHover() {
         document.querySelectorAll('.table').forEach(table => {
             setupHoverListener(table);
@@ -209,11 +300,13 @@
         setupMapHover();
         setupTableHover();
         setupCoordinateSelection();
+        setupClientMaps();
 
         document.addEventListener('iommi.loading.end', () => {
             setupMapHover();
             setupTableHover();
             setupCoordinateSelection();
+            setupClientMaps();
         });
     });
 
@@ -53,3 +53,6 @@ DATABASES = {
 ROOT_URLCONF = 'varsdaa.urls'
 SECRET_KEY = 'not to secret key for testing'
 STATIC_URL = '/static/'
+MEDIA_URL = '/media/'
+
+AUTH_USER_MODEL = "varsdaa.User"
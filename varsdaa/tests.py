@@ -1,19 +1,52 @@
+import hashlib
+import html
+import io
 import json
+import re
+from datetime import datetime, time, timedelta
 
 import pytest
+from allauth.socialaccount.models import SocialAccount, SocialApp
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from varsdaa.models import Desk, Display, Floor, Office, User
+from varsdaa.history import intervals_at_desks, occupied_time, utilization
+from varsdaa.ingest import apply_report, display_identity_cache, resolve_displays, user_identity_cache
+from varsdaa.map import Map, _pks
+from varsdaa.models import Desk, Display, Floor, Occupancy, OccupancyInterval, Office, Room, User
+from varsdaa.occupancy import refresh_occupancy
+from varsdaa.rollups import rollup_values
+from varsdaa.write_behind import write_behind_queue
 
 pytestmark = [
     pytest.mark.django_db,
 ]
 
 
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    cache.clear()
+    display_identity_cache.clear()
+    user_identity_cache.clear()
+
+
 @pytest.fixture
 def user():
     return User.objects.create(
         name="Putte Fisk",
+        client_name="Putte Fisk",
         email="putte@fisk.com",
     )
 
@@ -65,6 +98,8 @@ def test_register(client, user, payload, existing_display):
     user.refresh_from_db()
     assert user.display_set.count() == 1
     assert user.office == existing_display.desk.floor.office
+    assert user.current_desk == existing_display.desk
+    assert Desk.objects.get(pk=existing_display.desk.pk).current_occupant == user
     Display.objects.all().delete()
 
 
@@ -100,5 +135,829 @@ def test_register_new(client, user, payload, desk):
     user.refresh_from_db()
     assert user.display_set.count() == 1
     assert user.office == desk.floor.office
+    assert user.current_desk == desk
+    desk.refresh_from_db()
+    assert desk.current_occupant == user
 
     Display.objects.all().delete()
+
+
+def test_report_query_count_is_constant(client, user, payload, desk):
+    def report(full_name, displays):
+        with CaptureQueriesContext(connection) as context:
+            result = client.post(
+                reverse("report_display"),
+                json.dumps({**payload, "full_name": full_name, "displays": displays}),
+                content_type="application/json",
+            )
+        assert result.status_code == 200
+        return len(context.captured_queries)
+
+    other_user = User.objects.create(name="Kalle Anka", client_name="Kalle Anka", email="kalle@anka.com")
+    displays = [
+        Display.objects.create(
+            desk=desk,
+            product_name='DELL P3223QE',
+            serial_number=str(892416844 + i),
+            alphanumeric_serial_number=f"8Y064P{i}",
+        )
+        for i in range(6)
+    ]
+    display_reports = [
+        dict(
+            product_name=display.product_name,
+            serial_number=display.serial_number,
+            alphanumeric_serial_number=display.alphanumeric_serial_number,
+        )
+        for display in displays
+    ]
+
+    assert report(other_user.name, display_reports[:1]) == report(user.name, display_reports[1:])
+    assert user.display_set.count() == 5
+    user.refresh_from_db()
+    assert user.office == desk.floor.office
+
+
+def test_report_skips_writes_within_debounce(client, user, payload, existing_display, settings):
+    def report():
+        with CaptureQueriesContext(connection) as context:
+            result = client.post(
+                reverse("report_display"),
+                json.dumps(payload),
+                content_type="application/json",
+            )
+        assert result.status_code == 200
+        return [query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+
+    # The display, the office and the occupancy of the user and the desk
+    assert len(report()) == 4
+    existing_display.refresh_from_db()
+    user_updated_at = existing_display.user_updated_at
+
+    assert report() == []
+    existing_display.refresh_from_db()
+    assert existing_display.user_updated_at == user_updated_at
+
+    settings.VARSDAA_REPORT_DEBOUNCE_SECONDS = 0
+    # The display, when the occupancy was last seen, and the occupancy history interval it extends
+    update, touch, _ = report()
+    assert update.startswith('UPDATE "varsdaa_display"')
+    assert '"product_name"' not in update
+    assert touch.startswith('UPDATE "varsdaa_occupancy" SET "last_seen"')
+    existing_display.refresh_from_db()
+    assert existing_display.user_updated_at > user_updated_at
+    assert Occupancy.objects.get().last_seen == existing_display.user_updated_at
+
+
+def test_report_without_displays_disconnects_user(client, user, payload, existing_display):
+    existing_display.user = user
+    existing_display.save()
+
+    result = client.post(
+        reverse("report_display"),
+        json.dumps({**payload, "displays": []}),
+        content_type="application/json",
+    )
+    assert result.status_code == 200
+    assert result.json() == {}
+    assert user.display_set.count() == 0
+    user.refresh_from_db()
+    assert user.current_desk is None
+    assert Desk.objects.get(pk=existing_display.desk.pk).current_occupant is None
+
+
+def test_occupancy_follows_latest_display(client, user, payload, existing_display):
+    desk = existing_display.desk
+    other_desk = Desk.objects.create(floor=existing_display.desk.floor)
+    other_user = User.objects.create(name='Other', email='other@example.com')
+    Display.objects.create(desk=other_desk, product_name='DELL P3223QE', serial_number='1', user=other_user)
+    refresh_occupancy(user_pks=[other_user.pk], desk_pks=[other_desk.pk])
+    assert User.objects.get(pk=other_user.pk).current_desk == other_desk
+
+    client.post(reverse("report_display"), json.dumps(payload), content_type="application/json")
+    user.refresh_from_db()
+    assert user.current_desk == existing_display.desk
+    existing_display.refresh_from_db()
+    occupancy = Occupancy.objects.get(desk=existing_display.desk)
+    assert (occupancy.user, occupancy.floor, occupancy.office) == (user, desk.floor, desk.floor.office)
+    assert occupancy.last_seen == existing_display.user_updated_at
+
+    # The other user moves to the desk of the display the user just reported, taking it over
+    existing_display.refresh_from_db()
+    existing_display.user = other_user
+    existing_display.user_updated_at = existing_display.user_updated_at + timedelta(seconds=1)
+    existing_display.save()
+    User.objects.update(current_desk=None)
+    Desk.objects.update(current_occupant=None)
+    call_command("rebuild_occupancy")
+    assert User.objects.get(pk=user.pk).current_desk is None
+    assert User.objects.get(pk=other_user.pk).current_desk == existing_display.desk
+    assert Desk.objects.get(pk=existing_display.desk.pk).current_occupant == other_user
+    assert Desk.objects.get(pk=other_desk.pk).current_occupant == other_user
+    assert dict(Occupancy.objects.values_list("desk", "user")) == {desk.pk: other_user.pk, other_desk.pk: other_user.pk}
+
+    client.post(
+        reverse("report_display"),
+        json.dumps({**payload, "full_name": other_user.name, "displays": []}),
+        content_type="application/json",
+    )
+    assert not Occupancy.objects.exists()
+
+
+def test_occupancy_takes_previous_user_from_database(client, user, payload, existing_display):
+    first = User.objects.create(name='First', email='first@example.com')
+    second = User.objects.create(name='Second', email='second@example.com')
+    desk = existing_display.desk
+    existing_display.user = first
+    existing_display.save()
+    # The cache of this process has the display at the first user, another process handed it to the second
+    resolve_displays(payload["displays"])
+    Display.objects.filter(pk=existing_display.pk).update(user=second, user_updated_at=timezone.now())
+    refresh_occupancy(user_pks=[first.pk, second.pk], desk_pks=[desk.pk])
+    assert User.objects.get(pk=second.pk).current_desk == desk
+
+    client.post(reverse("report_display"), json.dumps(payload), content_type="application/json")
+    assert User.objects.get(pk=second.pk).current_desk is None
+    assert User.objects.get(pk=user.pk).current_desk == desk
+    assert Occupancy.objects.get().user == user
+
+
+def test_expire_displays(user, existing_display):
+    now = timezone.now()
+    displays = [existing_display] + [
+        Display.objects.create(desk=existing_display.desk, product_name='DELL P3223QE', serial_number=str(i))
+        for i in range(4)
+    ]
+    for i, display in enumerate(displays):
+        display.user = user
+        display.user_updated_at = now - timedelta(hours=i * 10)
+        display.save()
+    refresh_occupancy(user_pks=[user.pk], desk_pks=[existing_display.desk.pk])
+
+    # The displays reported 30 and 40 hours ago, in chunks of one
+    call_command("expire_displays", chunk_size=1)
+    assert set(user.display_set.all()) == set(displays[:3])
+    assert Occupancy.objects.filter(user=user).exists()
+
+    call_command("expire_displays", ttl=0)
+    assert not user.display_set.exists()
+    user.refresh_from_db()
+    assert user.current_desk is None
+    assert not Occupancy.objects.exists()
+
+
+def test_occupancy_history(user, existing_display):
+    desk = existing_display.desk
+    other_desk = Desk.objects.create(floor=desk.floor)
+    second_display = Display.objects.create(desk=desk, product_name='DELL P3223QE', serial_number='1')
+    identified, _ = resolve_displays(
+        [
+            dict(product_name='DELL P3223QE', serial_number=display.serial_number)
+            for display in [existing_display, second_display]
+        ]
+    )
+    start = timezone.now().replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    # Two displays reported every ten minutes for an hour, then after a gap for half an hour
+    for minutes in [*range(0, 70, 10), *range(120, 160, 10)]:
+        apply_report(user, identified, start + timedelta(minutes=minutes))
+    assert OccupancyInterval.objects.count() == 4
+    assert OccupancyInterval.objects.filter(display=existing_display).order_by("started_at")[0].ended_at == (
+        start + timedelta(hours=1)
+    )
+
+    end = start + timedelta(hours=4)
+    assert occupied_time(start, end) == {desk.pk: timedelta(minutes=90)}
+    assert occupied_time(start + timedelta(minutes=30), end, by="office") == {desk.floor.office_id: timedelta(hours=1)}
+    assert utilization(start, end) == {desk.pk: 90 / 240}
+    assert utilization(start, end, by="floor", pks=[desk.floor_id]) == {desk.floor_id: 90 / 480}
+    assert utilization(start, end, by="office", pks=[other_desk.floor.office_id + 1]) == {}
+
+
+def test_occupancy_history_is_index_backed(settings, user, existing_display):
+    settings.VARSDAA_OCCUPANCY_INTERVAL_MAX_SECONDS = 60 * 60
+    identified, _ = resolve_displays([dict(product_name='DELL P3223QE', serial_number=existing_display.serial_number)])
+    start = timezone.now().replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    for minutes in range(0, 150, 10):
+        apply_report(user, identified, start + timedelta(minutes=minutes))
+    # Intervals are split at the maximum length, so a range only scans the intervals started that long before it
+    assert list(OccupancyInterval.objects.order_by("started_at").values_list("started_at", "ended_at")) == [
+        (start, start + timedelta(hours=1)),
+        (start + timedelta(minutes=70), start + timedelta(minutes=130)),
+        (start + timedelta(minutes=140), start + timedelta(minutes=140)),
+    ]
+    end = start + timedelta(hours=3)
+    assert occupied_time(start + timedelta(minutes=90), end) == {existing_display.desk_id: timedelta(minutes=40)}
+    assert "USING INDEX interval_started " in intervals_at_desks(start, end).explain()
+
+
+def test_occupancy_rollups(client, user, existing_display):
+    desk = existing_display.desk
+    desk.x = desk.y = 10
+    desk.save()
+    floor, office = desk.floor, desk.floor.office
+    other_desk = Desk.objects.create(floor=floor, x=20, y=20)
+    day = timezone.localdate() - timedelta(days=1)
+    nine = timezone.make_aware(datetime.combine(day, time(9)))
+    for display_desk, started_at, ended_at in [
+        # Two displays on one desk from 9:00 to 10:30, the second one overlapping the first
+        (desk, nine, nine + timedelta(hours=1)),
+        (desk, nine + timedelta(minutes=30), nine + timedelta(minutes=90)),
+        (other_desk, nine + timedelta(minutes=45), nine + timedelta(minutes=75)),
+    ]:
+        OccupancyInterval.objects.create(
+            display=existing_display,
+            user=user,
+            desk=display_desk,
+            floor=floor,
+            office=office,
+            started_at=started_at,
+            ended_at=ended_at,
+        )
+
+    call_command("update_occupancy_rollups")
+    hourly = rollup_values("desk", "hour", day, day)
+    assert hourly[desk.pk][8:12] == [0, 60, 30, 0]
+    assert hourly[other_desk.pk][9:11] == [15, 15]
+    assert rollup_values("floor", "hour", day, day)[floor.pk][8:12] == [0, 2, 2, 0]
+    assert rollup_values("desk", "day", day - timedelta(days=1), day) == {desk.pk: [0, 90], other_desk.pk: [0, 30]}
+    assert rollup_values("office", "day", day, day) == {office.pk: [2]}
+
+    # Recomputing the same days changes nothing
+    call_command("update_occupancy_rollups")
+    assert rollup_values("desk", "day", day, day)[desk.pk] == [90]
+
+    result = client.get(reverse("occupancy_rollups", args=["floor", "day"]), {"start": day, "end": day})
+    assert result.json() == {
+        "scope": "floor",
+        "resolution": "day",
+        "start": day.isoformat(),
+        "end": day.isoformat(),
+        "values": {str(floor.pk): [2]},
+    }
+    assert client.get(reverse("occupancy_rollups", args=["desk", "hour"]), {"pk": other_desk.pk}).json()["values"] == {
+        str(other_desk.pk): [0] * (5 * 24 + 9) + [15, 15] + [0] * (24 + 13)
+    }
+    assert client.get(reverse("occupancy_rollups", args=["desk", "hour"]), {"start": "2020-01-01"}).status_code == 400
+    assert client.get(reverse("occupancy_rollups", args=["room", "day"])).status_code == 404
+
+    content = client.get(f'/floor/{floor.pk}/').content.decode()
+    assert f'class="desk heat-4 marked" cx="10" cy="10" data-desk="{desk.pk}"' in content
+    assert f'class="desk heat-1 marked" cx="20" cy="20" data-desk="{other_desk.pk}"' in content
+
+
+def test_display_changes_refresh_occupancy(client, user, existing_display):
+    desk = existing_display.desk
+    desk.x = desk.y = 10
+    desk.save()
+    existing_display.user = user
+    existing_display.save()
+    user.refresh_from_db()
+    assert user.current_desk == desk
+    assert Occupancy.objects.get().user == user
+
+    other_desk = Desk.objects.create(floor=desk.floor, x=20, y=20)
+    existing_display.desk = other_desk
+    existing_display.save()
+    assert Occupancy.objects.get().desk == other_desk
+    assert Desk.objects.get(pk=desk.pk).current_occupant is None
+    desk_url = reverse("desk_show", args=[other_desk.pk])
+    connected = re.compile(r'class="[^"]*\bconnected\b')
+    assert connected.search(client.get(desk_url).content.decode())
+
+    existing_display.delete()
+    user.refresh_from_db()
+    assert user.current_desk is None
+    assert not Occupancy.objects.exists()
+    assert Desk.objects.get(pk=other_desk.pk).current_occupant is None
+    assert not connected.search(client.get(desk_url).content.decode())
+
+
+def test_admin_edit_keeps_occupancy(client, user, existing_display):
+    existing_display.user = user
+    existing_display.save()
+    refresh_occupancy(user_pks=[user.pk], desk_pks=[existing_display.desk.pk])
+    client.force_login(User.objects.create(name='Admin', email='admin@example.com', is_staff=True, is_superuser=True))
+    desk = existing_display.desk
+
+    result = client.get(f'/admin/varsdaa/desk/{desk.pk}/edit/')
+    form = result.context['root'].parts.edit_varsdaa_desk
+    client.post(
+        f'/admin/varsdaa/desk/{desk.pk}/edit/',
+        {'floor': desk.floor.pk, 'x': 1, 'y': 2, form.actions.submit.own_target_marker(): ''},
+    )
+    desk.refresh_from_db()
+    assert desk.x == 1
+    assert desk.current_occupant == user
+
+
+def test_report_ignores_empty_serial_numbers(client, user, payload, desk):
+    for serial_number in ["892416844", "892416845"]:
+        Display.objects.create(
+            desk=desk,
+            product_name='DELL P3223QE',
+            serial_number=serial_number,
+            alphanumeric_serial_number="",
+        )
+
+    payload["displays"][0]["alphanumeric_serial_number"] = ""
+    result = client.post(
+        reverse("report_display"),
+        json.dumps(payload),
+        content_type="application/json",
+    )
+    assert result.status_code == 200
+    assert result.json() == {}
+    assert list(user.display_set.values_list("serial_number", flat=True)) == ["892416844"]
+
+
+def test_display_identity_is_unique(existing_display):
+    with pytest.raises(IntegrityError):
+        Display.objects.create(
+            product_name=existing_display.product_name,
+            serial_number="1",
+            alphanumeric_serial_number=existing_display.alphanumeric_serial_number,
+        )
+
+
+def test_report_resolves_displays_from_cache(client, user, payload, existing_display):
+    def report():
+        with CaptureQueriesContext(connection) as context:
+            result = client.post(
+                reverse("report_display"),
+                json.dumps(payload),
+                content_type="application/json",
+            )
+        assert result.status_code == 200
+        return [query["sql"] for query in context.captured_queries if "varsdaa_display" in query["sql"]]
+
+    # Looking up, locking and updating the display, then reading the occupancy of the user and the desk from it
+    assert len(report()) == 5
+    hits = display_identity_cache.cache_info().hits
+    assert report() == []
+    assert display_identity_cache.cache_info().hits == hits + 1
+
+    existing_display.desk.save()
+    assert display_identity_cache.cache_info().currsize == 0
+    assert len(report()) == 1
+
+
+def test_report_write_behind(client, user, payload, existing_display, settings, monkeypatch):
+    settings.VARSDAA_REPORT_WRITE_BEHIND = True
+    monkeypatch.setattr(write_behind_queue, "start", lambda: None)
+
+    unknown_display_report = dict(product_name="DELL U2720Q", serial_number="123", alphanumeric_serial_number="ABC")
+    for displays in [[unknown_display_report], payload["displays"] + [unknown_display_report]]:
+        result = client.post(
+            reverse("report_display"),
+            json.dumps({**payload, "displays": displays}),
+            content_type="application/json",
+        )
+        assert result.status_code == 200
+        assert result.json()["url"].endswith(
+            "?product_name=DELL+U2720Q&serial_number=123&alphanumeric_serial_number=ABC"
+        )
+
+    assert user.display_set.count() == 0
+
+    write_behind_queue.flush()
+    assert list(user.display_set.all()) == [existing_display]
+    user.refresh_from_db()
+    assert user.office == existing_display.desk.floor.office
+
+
+def test_report_write_behind_isolates_failures(user, existing_display, monkeypatch):
+    monkeypatch.setattr(write_behind_queue, "start", lambda: None)
+    identified, _ = resolve_displays([dict(product_name='DELL P3223QE', serial_number=existing_display.serial_number)])
+    other_display = Display.objects.create(desk=existing_display.desk, product_name='DELL P3223QE', serial_number='1')
+    other_identified, _ = resolve_displays([dict(product_name='DELL P3223QE', serial_number='1')])
+    deleted_user = User.objects.create(name='Deleted', email='deleted@example.com')
+
+    # The report of a user deleted before the flush is dropped, writing it would violate a foreign key
+    write_behind_queue.enqueue(deleted_user, other_identified, timezone.now())
+    write_behind_queue.enqueue(user, identified, timezone.now())
+    deleted_user.delete()
+    write_behind_queue.flush()
+    assert list(user.display_set.all()) == [existing_display]
+    other_display.refresh_from_db()
+    assert other_display.user is None
+
+    # A failing batch is applied report by report
+    def fail(reports):
+        raise IntegrityError
+
+    monkeypatch.setattr("varsdaa.write_behind.apply_reports", fail)
+    other_user = User.objects.create(name='Other', email='other@example.com')
+    write_behind_queue.enqueue(other_user, identified, timezone.now())
+    write_behind_queue.flush()
+    assert list(other_user.display_set.all()) == [existing_display]
+
+
+def test_register_async(async_client, user, payload, existing_display):
+    result = async_to_sync(async_client.post)(
+        reverse("report_display_async"),
+        json.dumps(payload),
+        content_type="application/json",
+    )
+    assert result.status_code == 200
+    assert result.json() == {}
+    assert list(user.display_set.all()) == [existing_display]
+    user.refresh_from_db()
+    assert user.office == existing_display.desk.floor.office
+
+    payload["displays"][0]["serial_number"] = "123"
+    payload["displays"][0]["alphanumeric_serial_number"] = "ABC"
+    result = async_to_sync(async_client.post)(
+        reverse("report_display_async"),
+        json.dumps(payload),
+        content_type="application/json",
+    )
+    assert result.status_code == 200
+    assert 'person/putte@fisk.com/register_display?product_name=DELL+P3223QE' in result.json()["url"]
+    assert user.display_set.count() == 0
+
+
+def test_report_displays_bulk(client, user, payload, existing_display):
+    other_user = User.objects.create(name="Kalle Anka", email="kalle@anka.com")
+    other_user.display_set.add(
+        Display.objects.create(product_name='DELL U2720Q', serial_number="1", alphanumeric_serial_number="A"),
+    )
+    reports = [
+        payload,
+        {
+            "full_name": other_user.name,
+            "displays": [dict(product_name="DELL U2720Q", serial_number="123", alphanumeric_serial_number="ABC")],
+        },
+        {"full_name": "Nobody", "displays": []},
+    ]
+
+    result = client.post(reverse("report_displays"), json.dumps(reports), content_type="application/json")
+    assert result.status_code == 200
+    results = result.json()
+    assert results[0] == {"full_name": user.name}
+    assert results[1]["full_name"] == other_user.name
+    assert results[1]["url"].endswith(
+        'person/kalle@anka.com/register_display'
+        '?product_name=DELL+U2720Q&serial_number=123&alphanumeric_serial_number=ABC'
+    )
+    assert results[2] == {"full_name": "Nobody", "error": "Unknown user"}
+
+    assert list(user.display_set.all()) == [existing_display]
+    assert other_user.display_set.count() == 0
+    user.refresh_from_db()
+    assert user.office == existing_display.desk.floor.office
+
+
+def test_report_resolves_user_by_client_name(client, payload, existing_display):
+    def report(full_name):
+        return client.post(
+            reverse("report_display"),
+            json.dumps({**payload, "full_name": full_name}),
+            content_type="application/json",
+        )
+
+    user = User.objects.create(name="Kalle Anka", email="kalle@anka.com")
+    assert report(user.name).status_code == 200
+    user.refresh_from_db()
+    assert user.client_name == "Kalle Anka"
+    assert list(user.display_set.all()) == [existing_display]
+
+    # Saving the new office cleared the cache
+    assert report(user.name).status_code == 200
+    with CaptureQueriesContext(connection) as context:
+        assert report(user.name).status_code == 200
+    assert not [query for query in context.captured_queries if "varsdaa_user" in query["sql"]]
+
+    User.objects.create(name="Joakim von Anka", email="joakim@anka.com")
+    User.objects.create(name="Joakim von Anka", email="joakim@vonanka.com")
+    assert report("Joakim von Anka").status_code == 404
+
+
+def test_report_refuses_namesake_of_claimed_user(client, payload, existing_display):
+    def report(user_name):
+        return client.post(
+            reverse("report_display"),
+            json.dumps({**payload, "user_name": user_name, "full_name": "Bob"}),
+            content_type="application/json",
+        )
+
+    first = User.objects.create(name="Bob", email="bob@example.com")
+    assert report("bob").status_code == 200
+    first.refresh_from_db()
+    assert first.client_name == "Bob"
+
+    # A namesake created after the claim doesn't report as the first Bob, and neither does the first Bob until told apart
+    second = User.objects.create(name="Bob", email="bob@example.org")
+    assert report("bobby").status_code == 404
+    assert report("bob").status_code == 404
+    assert list(first.display_set.all()) == [existing_display]
+
+    second.client_name = "bobby"
+    second.save()
+    assert report("bobby").status_code == 200
+    assert list(second.display_set.all()) == [existing_display]
+    assert report("bob").status_code == 200
+    assert list(first.display_set.all()) == [existing_display]
+
+
+def test_map_query_count_is_constant_in_number_of_floors(client):
+    office = Office.objects.create(display_name='Office building A')
+
+    def render_rooms():
+        floor = Floor.objects.create(display_name=f'Floor {Floor.objects.count()}', office=office)
+        Room.objects.create(display_name=f'Room {floor.pk}', floor=floor, x=10, y=10, width=100, height=100)
+        with CaptureQueriesContext(connection) as context:
+            result = client.get(reverse("where"))
+        assert result.status_code == 200
+        assert result.content.count(b'<svg') == Floor.objects.count()
+        return len(context.captured_queries)
+
+    assert render_rooms() == render_rooms() == render_rooms()
+
+
+def test_map_query_count_is_constant_in_number_of_desks(client, user, desk):
+    def render_desks():
+        new_desk = Desk.objects.create(floor=desk.floor, x=10 * Desk.objects.count(), y=10)
+        Display.objects.create(
+            desk=new_desk,
+            product_name='DELL P3223QE',
+            serial_number=str(new_desk.pk),
+            alphanumeric_serial_number=f"8Y064P{new_desk.pk}",
+            user=user,
+        )
+        refresh_occupancy(desk_pks=[new_desk.pk])
+        with CaptureQueriesContext(connection) as context:
+            result = client.get(desk.get_absolute_url())
+        assert result.status_code == 200
+        assert result.content.count(b'class="connected desk"') == Desk.objects.count() - 1
+        return len(context.captured_queries)
+
+    assert render_desks() == render_desks() == render_desks()
+
+
+def test_map_pks(desk):
+    with CaptureQueriesContext(connection) as context:
+        assert _pks(Desk.objects.all()) == {desk.pk}
+    [query] = context.captured_queries
+    assert '"varsdaa_desk"."x"' not in query["sql"]
+
+    desks = Desk.objects.all()
+    list(desks)
+    with CaptureQueriesContext(connection) as context:
+        assert _pks(desks) == {desk.pk}
+        assert _pks([desk]) == {desk.pk}
+        assert _pks(None) == set()
+    assert not context.captured_queries
+
+
+def test_map_composes_querysets_as_subqueries(client, desk):
+    desk.x = desk.y = 10
+    desk.save()
+
+    with CaptureQueriesContext(connection) as context:
+        result = client.get(desk.get_absolute_url())
+    assert result.status_code == 200
+    assert f'data-desk="{desk.pk}"' in result.content.decode()
+
+    [query] = [query["sql"] for query in context.captured_queries if 'EXISTS' in query["sql"]]
+    assert 'IN (SELECT' in query
+    selected = query[: query.index(" FROM ")]
+    assert '"varsdaa_desk"."id" AS' in selected
+    assert '"varsdaa_desk"."x" AS' not in selected
+
+
+def test_map_caches_static_layer(client, desk):
+    desk.x = desk.y = 10
+    desk.save()
+
+    def render():
+        with CaptureQueriesContext(connection) as context:
+            result = client.get(desk.get_absolute_url())
+        assert result.status_code == 200
+        return result.content.decode(), [query["sql"] for query in context.captured_queries]
+
+    content, queries = render()
+    assert (
+        f'<a href="/desk/{desk.pk}/"><circle class="desk marked" cx="10" cy="10" data-desk="{desk.pk}" r="10">'
+        in content
+    )
+    assert any('"varsdaa_desk"."x" AS' in query for query in queries)
+
+    content, queries = render()
+    assert '<circle class="desk marked" cx="10" cy="10"' in content
+    assert not any('"varsdaa_desk"."x" AS' in query for query in queries)
+
+    desk.x = 20
+    desk.save()
+    content, queries = render()
+    assert '<circle class="desk marked" cx="20" cy="10"' in content
+
+
+def test_map_renderers_render_the_same_markup(rf, desk):
+    desk.x = desk.y = 10
+    desk.save()
+    Desk.objects.create(floor=desk.floor, x=20, y=30)
+    Room.objects.create(display_name='Room A', floor=desk.floor, x=1, y=2, width=30, height=40)
+    Room.objects.create(display_name='Room B', floor=desk.floor, x=5, y=6, height=4)
+
+    def render(renderer):
+        return Map(renderer=renderer).bind(request=rf.get('/'))._render_static_layers([desk.floor.pk])
+
+    layers = render('iommi')
+    assert len(layers[desk.floor.pk]["desks"]) == len(layers[desk.floor.pk]["rooms"]) == 2
+    assert render('string') == layers
+
+
+def test_map_geometry(client, desk):
+    desk.x = desk.y = 10
+    desk.save()
+    room = Room.objects.create(display_name='Room A', floor=desk.floor, x=1, y=2, width=30, height=40)
+    url = reverse("floor_map", kwargs={"floor_pk": desk.floor.pk})
+
+    result = client.get(url)
+    assert result.status_code == 200
+    assert result.json() == {"desks": [[desk.pk, 10, 10]], "rooms": [[room.pk, 1, 2, 30, 40]]}
+    etag = result["ETag"]
+
+    with CaptureQueriesContext(connection) as context:
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert not context.captured_queries
+
+    desk.x = 20
+    desk.save()
+    result = client.get(url, headers={"If-None-Match": etag})
+    assert result.status_code == 200
+    assert result.json()["desks"] == [[desk.pk, 20, 10]]
+
+
+def test_map_client_renderer(client, desk, user, settings):
+    settings.VARSDAA_MAP_RENDERER = "client"
+    desk.x = desk.y = 10
+    desk.save()
+    other_desk = Desk.objects.create(floor=desk.floor, x=20, y=20)
+    Display.objects.create(desk=other_desk, product_name='DELL P3223QE', serial_number="1", user=user)
+    refresh_occupancy(desk_pks=[other_desk.pk])
+
+    content = client.get(desk.get_absolute_url()).content.decode()
+    assert '<circle' not in content
+    assert f'data-map-geometry="{reverse("floor_map", kwargs={"floor_pk": desk.floor.pk})}"' in content
+
+    [state_url] = re.findall(r'data-map-state="([^"]*)"', content)
+    with CaptureQueriesContext(connection) as context:
+        result = client.get(desk.get_absolute_url() + html.unescape(state_url))
+    assert result.status_code == 200
+    # Only the shapes of the floor asked for are fetched
+    [shapes_query] = [query["sql"] for query in context.captured_queries if 'AS "connected"' in query["sql"]]
+    assert '"varsdaa_desk"."floor_id" = %s' in shapes_query
+    assert result.json() == {
+        "desks": [desk.pk, other_desk.pk],
+        "rooms": [],
+        "marked_desks": [desk.pk],
+        "marked_rooms": [],
+        "connected_desks": [other_desk.pk],
+        "heat": {},
+    }
+    result = client.get(desk.get_absolute_url() + html.unescape(state_url), headers={"If-None-Match": result["ETag"]})
+    assert result.status_code == 304
+
+    invalid_url = re.sub(r"=\d+$", "=abc", html.unescape(state_url))
+    assert client.get(desk.get_absolute_url() + invalid_url).status_code == 400
+
+
+def test_floor_image_conditional_get(client, desk):
+    floor = desk.floor
+    floor.set_image(b'png')
+    floor.save()
+    url = reverse("floor_image", kwargs={"floor_pk": floor.pk})
+
+    result = client.get(url)
+    assert result.status_code == 200
+    assert b''.join(result.streaming_content) == b'png'
+    assert result["ETag"] == f'"{floor.image_hash}"'
+    assert 'no-cache' in result["Cache-Control"]
+
+    with CaptureQueriesContext(connection) as context:
+        result = client.get(url, headers={"If-None-Match": result["ETag"]})
+    assert result.status_code == 304
+    [query] = context.captured_queries
+    assert '"varsdaa_floor"."image"' not in query["sql"]
+
+    result = client.get(floor.get_image_url())
+    assert result.status_code == 200
+    assert b''.join(result.streaming_content) == b'png'
+    assert 'immutable' in result["Cache-Control"]
+
+    old_url = floor.get_image_url()
+    floor.set_image(b'new png')
+    floor.save()
+    assert client.get(old_url)["Location"] == floor.get_image_url()
+
+
+def test_floor_image_range(client, desk, settings):
+    floor = desk.floor
+    floor.set_image(b'0123456789')
+    floor.save()
+    assert floor.image.name == f'floors/{floor.image_hash}.png'
+    url = floor.get_image_url()
+
+    def get(byte_range, **headers):
+        return client.get(url, headers={"Range": byte_range, **headers})
+
+    result = get('bytes=2-4')
+    assert result.status_code == 206
+    assert result["Content-Range"] == 'bytes 2-4/10'
+    assert b''.join(result.streaming_content) == b'234'
+    assert b''.join(get('bytes=7-').streaming_content) == b'789'
+    assert b''.join(get('bytes=-2').streaming_content) == b'89'
+    assert get('bytes=10-').status_code == 416
+    assert get('bytes=2-4', **{"If-Range": '"outdated"'}).status_code == 200
+
+    settings.VARSDAA_SERVE_FLOOR_IMAGES_FROM_STORAGE = True
+    assert floor.get_image_url() == f'/media/floors/{floor.image_hash}.png'
+
+
+def test_edit_floor_sets_image_hash(client, desk):
+    desk.x = desk.y = 10
+    desk.save()
+    floor = desk.floor
+    result = client.post(
+        f"/floor/{floor.pk}/edit/",
+        {
+            "display_name": floor.display_name,
+            "office": floor.office.pk,
+            "image": SimpleUploadedFile("floor.png", b'png', content_type="image/png"),
+            "-submit": "",
+        },
+    )
+    assert result.status_code == 302
+    floor.refresh_from_db()
+    assert floor.image_hash == hashlib.sha256(b'png').hexdigest()
+
+    content = client.get(desk.get_absolute_url()).content.decode()
+    assert f'href="{floor.get_image_url("map")}"' in content
+
+
+def test_floor_image_renditions(client, desk):
+    floor = desk.floor
+    floor.set_image(b'\xff\xd8\xffjpeg')
+    assert floor.image.name == f'floors/{floor.image_hash}.jpg'
+    storage = floor.image.storage
+    floor.image_renditions["thumbnail"] = {
+        "image/webp": storage.save(f'floors/{floor.image_hash}/thumbnail.webp', ContentFile(b'webp thumbnail')),
+        "image/png": storage.save(f'floors/{floor.image_hash}/thumbnail.png', ContentFile(b'png thumbnail')),
+    }
+    floor.save()
+
+    def get(size, accept="*/*"):
+        url = floor.get_image_url(size)
+        result = client.get(url, headers={"Accept": accept})
+        assert result.status_code == 200
+        return result["Content-Type"], b''.join(result.streaming_content)
+
+    assert get(None) == ('image/jpeg', b'\xff\xd8\xffjpeg')
+    assert get('thumbnail') == ('image/png', b'png thumbnail')
+    assert get('thumbnail', accept='image/avif,image/webp,*/*') == ('image/webp', b'webp thumbnail')
+    # Without derivatives of a size, the original is served
+    assert get('map') == ('image/jpeg', b'\xff\xd8\xffjpeg')
+
+    assert f'src="{floor.get_thumbnail_url()}"' in client.get(reverse("floor_list")).content.decode()
+
+
+def test_create_floor_image_derivatives(desk):
+    pil_image = pytest.importorskip("PIL.Image")
+    output = io.BytesIO()
+    pil_image.new("RGB", (2000, 800)).save(output, format="PNG")
+    floor = desk.floor
+    floor.set_image(output.getvalue())
+    floor.save()
+
+    call_command("create_floor_image_derivatives")
+    floor.refresh_from_db()
+    assert {"original", "thumbnail", "map"} <= floor.image_renditions.keys()
+    with floor.image.storage.open(floor.image_renditions["map"]["image/png"]) as file:
+        assert pil_image.open(file).size == (1000, 400)
+
+
+def test_who_query_count(client, desk, django_assert_num_queries):
+    desk.x = desk.y = 10
+    desk.save()
+    SocialApp.objects.create(provider='google', name='Google', client_id='id', secret='secret')
+
+    def add_user():
+        i = User.objects.count()
+        user = User.objects.create(name=f'User {i}', email=f'user{i}@example.com', office=desk.floor.office)
+        SocialAccount.objects.create(user=user, provider='google', uid=str(i), extra_data={'picture': f'/{i}.png'})
+        Display.objects.create(desk=desk, product_name='DELL P3223QE', serial_number=str(i), user=user)
+        refresh_occupancy(user_pks=[user.pk], desk_pks=[desk.pk])
+
+    add_user()
+    client.get(reverse("who"))
+    with django_assert_num_queries(7):
+        result = client.get(reverse("who"))
+    assert b'src="/0.png"' in result.content
+    assert f'data-desk="{desk.pk}"'.encode() in result.content
+
+    for _ in range(4):
+        add_user()
+    with django_assert_num_queries(7):
+        result = client.get(reverse("who"))
+    assert b'src="/4.png"' in result.content
@@ -18,7 +18,12 @@ urlpatterns = [
     path("floor/", ListFloor().as_view(), name="floor_list"),
     path("floor/<int:floor_pk>/", ShowFloor().as_view(), name="floor_edit"),
     path("floor/<int:floor_pk>/edit/", EditFloor().as_view(), name="floor_edit"),
+    path("floor/<int:floor_pk>/map/", views.floor_map, name="floor_map"),
     path("floor/<int:floor_pk>/image/", views.floor_image, name="floor_image"),
+    path("floor/<int:floor_pk>/image/<str:image_hash>/", views.floor_image, name="floor_image_version"),
+    path("occupancy/<str:scope>/<str:resolution>/", views.occupancy_rollups, name="occupancy_rollups"),
     path("admin/", include(VarsdaaAdmin.urls())),
     path("report_display/", register.report_display, name="report_display"),
+    path("report_display_async/", register.areport_display, name="report_display_async"),
+    path("report_displays/", register.report_displays, name="report_displays"),
 ]
@@ -1,14 +1,23 @@
+from datetime import date, timedelta
+
 from allauth.socialaccount.adapter import get_adapter
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
+from django.utils.text import format_lazy
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from iommi import LAST, html
 
+from varsdaa.images import create_image_derivatives, floor_image_response
+from varsdaa.ingest import disconnect_displays
 from varsdaa.iommi import Column, Field, Form, Page, Table
-from varsdaa.map import Map
+from varsdaa.map import Map, floor_geometry, floor_version, json_response_with_etag
 from varsdaa.models import Desk, Floor, Office, Room, User
+from varsdaa.rollups import RESOLUTIONS, SCOPES, desk_heat, rollup_values
 
 
 def index(request):
@@ -31,6 +40,7 @@ def index(request):
 class RoomTable(Table):
     class Meta:
         auto__model = Room
+        rows = Room.objects.select_related("floor__office")
         auto__include = ["display_name", "floor__office", "floor"]
 
         columns__display_name = dict(
@@ -58,34 +68,52 @@ def where(request):
 
 
 def desks_for_users(users):
-    result = []
-    for user in users:
-        for d in user.display_set.all():
-            result.append(d.desk)
-    return result
+    return [user.current_desk for user in users if user.current_desk_id is not None]
 
 
 def desk_pk_for_user(user):
-    for d in user.display_set.all():
-        return d.desk.pk
-    return None
+    return user.current_desk_id
+
+
+def avatar_url_for_user(user, request, providers):
+    """
+    The avatar of the first social account of `user`. `providers` is a dict from provider id to provider, filled in as
+    providers are looked up: looking one up reads its social app, so share the dict between the rows of a table.
+    """
+    # Not .first(), that would query instead of using the prefetched accounts
+    account = next(iter(user.socialaccount_set.all()), None)
+    if account is None:
+        return None
+
+    if account.provider not in providers:
+        providers[account.provider] = get_adapter().get_provider(request, account.provider)
+    return providers[account.provider].wrap_account(account).get_avatar_url()
 
 
 class UserTable(Table):
     class Meta:
         model = User
         title = "Users"
+        rows = (
+            User.objects.filter(is_superuser=False)
+            .select_related("office", "current_desk")
+            .prefetch_related("socialaccount_set")
+        )
         row__attrs = {
             "data-desk": lambda row, **_: desk_pk_for_user(row),
         }
         container__children__map = Map(
             desks_all=lambda table, **_: desks_for_users(table.get_visible_rows()),
-            desks_marked=lambda table, **_: desks_for_users(table.rows),
+            desks_marked=lambda table, **_: Desk.objects.filter(occupancy__user__in=table.rows.values("pk")),
             after=LAST,
         )
 
     avatar = Column(
-        cell__value=lambda row, **_: s.get_avatar_url() if (s := row.socialaccount_set.first()) is not None else None,
+        # Evaluated once per render, the providers are looked up once per table
+        extra_evaluated__providers=lambda **_: {},
+        cell__value=lambda row, request, column, **_: avatar_url_for_user(
+            row, request, column.extra_evaluated.providers
+        ),
         cell__format=lambda value, **_: format_html('<img src="{}" />', value) if value else "",
     )
     email = Column.from_model(
@@ -104,7 +132,7 @@ class UserTable(Table):
 
 def who(request):
     return Page(
-        parts__users=UserTable(rows=lambda **_: User.objects.filter(is_superuser=False)),
+        parts__users=UserTable(),
     )
 
 
@@ -113,11 +141,11 @@ def me(request):
 
 
 def who_details(request, email):
-    user = get_object_or_404(User, email=email)
+    user = get_object_or_404(User.objects.select_related("current_desk"), email=email)
 
     def on_save(instance, **_):
         # Clear all previously connected displays
-        instance.display_set.set([])
+        disconnect_displays([instance])
 
     return Page(
         parts__heading=html.h1(user.name or user.email),
@@ -154,6 +182,7 @@ def who_details(request, email):
 class FloorForm(Form):
     class Meta:
         auto__model = Floor
+        auto__exclude = ["image_hash", "image_updated_at", "image_renditions"]
 
         @staticmethod
         def instance(floor_pk, **_):
@@ -162,13 +191,30 @@ class FloorForm(Form):
         @staticmethod
         def fields__image__write_to_instance(field, instance, value, **kwargs):
             if value:
-                instance.image = value.read()
+                image = value.read()
+                instance.set_image(image)
+                create_image_derivatives(instance, image)
 
     image = Field.image()
 
 
+HEAT_DAYS = 30
+
+
+def floor_heat(floor_pk):
+    today = timezone.localdate()
+    return desk_heat(today - timedelta(days=HEAT_DAYS - 1), today, Desk.objects.filter(floor=floor_pk).values("pk"))
+
+
 class ShowFloor(Page):
     form = FloorForm(editable=False)
+    heat_title = html.h2(format_lazy(_("Occupancy the last {days} days"), days=HEAT_DAYS))
+    heat = Map(
+        floors_all=lambda floor_pk, **_: Floor.objects.filter(pk=floor_pk),
+        desks_all=lambda floor_pk, **_: Desk.objects.filter(floor=floor_pk),
+        desks_marked=lambda floor_pk, **_: Desk.objects.filter(floor=floor_pk),
+        heat=lambda floor_pk, **_: floor_heat(floor_pk),
+    )
 
 
 class EditFloor(Page):
@@ -222,7 +268,7 @@ class DeskForm(Form):
 
         @staticmethod
         def instance(desk_pk, **_):
-            return get_object_or_404(Desk, pk=desk_pk)
+            return get_object_or_404(Desk.objects.select_related("current_occupant"), pk=desk_pk)
 
         fields__map = Map(
             desks_all=lambda instance, **_: Desk.objects.filter(floor=instance.floor),
@@ -231,7 +277,7 @@ class DeskForm(Form):
 
     who = Field(
         display_name=_("who").title(),
-        initial=lambda instance, **_: ", ".join(instance.display_set.values_list("user__name", flat=True)),
+        initial=lambda instance, **_: instance.current_occupant.name if instance.current_occupant else "",
     )
 
 
@@ -249,6 +295,47 @@ class ListFloor(Page):
     )
 
 
-def floor_image(request, floor_pk):
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request, floor_pk: str(floor_version(floor_pk)))
+def floor_map(request, floor_pk):
     floor = get_object_or_404(Floor, pk=floor_pk)
-    return HttpResponse(floor.image, content_type="image/png")
+    return JsonResponse(floor_geometry(floor.pk))
+
+
+def floor_image(request, floor_pk, image_hash=None):
+    return floor_image_response(request, floor_pk, image_hash)
+
+
+# The longest range of each resolution one request can ask for, in days
+MAX_ROLLUP_DAYS = {"hour": 31, "day": 366}
+
+
+def occupancy_rollups(request, scope, resolution):
+    """
+    The occupancy rollups of the desks, floors or offices given by `pk` parameters, or all of them, as JSON. `start`
+    and `end` are ISO dates, by default the last week for hourly rollups and the last year for daily ones.
+    """
+    if scope not in SCOPES or resolution not in RESOLUTIONS:
+        raise Http404
+    try:
+        end = date.fromisoformat(request.GET["end"]) if "end" in request.GET else timezone.localdate()
+        if "start" in request.GET:
+            start = date.fromisoformat(request.GET["start"])
+        else:
+            start = end - timedelta(days=6 if resolution == "hour" else 364)
+        pks = [int(pk) for pk in request.GET.getlist("pk")] or None
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if not 0 <= (end - start).days < MAX_ROLLUP_DAYS[resolution]:
+        return HttpResponseBadRequest(f"At most {MAX_ROLLUP_DAYS[resolution]} days of {resolution}ly rollups")
+
+    return json_response_with_etag(
+        request,
+        {
+            "scope": scope,
+            "resolution": resolution,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "values": rollup_values(scope, resolution, start, end, pks),
+        },
+    )
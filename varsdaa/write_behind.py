@@ -0,0 +1,75 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from varsdaa.ingest import apply_report, apply_reports
+from varsdaa.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Collects the outcome of display reports and applies them in batches from a background thread, every `interval`
+    seconds. Reports are coalesced per user: only the latest report of each user since the last flush is written. If a
+    batch fails, its reports are applied one by one, so one bad report doesn't lose the others.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, user, identified, timestamp):
+        with self._lock:
+            self._pending[user.pk] = (user, identified, timestamp)
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="varsdaa-write-behind", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        # Users deleted since their report would fail the whole batch on commit
+        existing = set(User.objects.filter(pk__in=pending).values_list("pk", flat=True))
+        for pk in pending.keys() - existing:
+            logger.warning("Dropping display report of deleted user %s", pk)
+        reports = [report for pk, report in pending.items() if pk in existing]
+
+        try:
+            apply_reports(reports)
+        except Exception:
+            logger.exception("Failed to apply %s display reports in one batch, applying them one by one", len(reports))
+            for user, identified, timestamp in reports:
+                try:
+                    with transaction.atomic():
+                        apply_report(user, identified, timestamp)
+                except Exception:
+                    logger.exception("Failed to apply display report of user %s", user.pk)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush display reports")
+            finally:
+                close_old_connections()
+
+
+write_behind_queue = WriteBehindQueue(interval=getattr(settings, "VARSDAA_WRITE_BEHIND_INTERVAL", 1.0))
+atexit.register(write_behind_queue.flush)